@@ -2,7 +2,8 @@ import os
 import json
 import sqlite3
 import StringIO
-from time import sleep
+import threading
+from time import sleep, time
 
 from logger import log
 from utils import toUnicode
@@ -10,6 +11,14 @@ from utils import toUnicode
 dbConn = None
 cursor = None
 
+# Finders call MusicBrainz and MusicDNS from several threads at once, so the
+# connection is shared between threads and every use of it takes dbLock.
+dbLock = threading.RLock()
+
+# MusicBrainz asks that clients make no more than one request per second.
+mbLock = threading.Lock()
+lastMBRequest = [0]
+
 class Stats(object):
     """Wrapper around some ints."""
     
@@ -26,30 +35,45 @@ def loadCacheDB():
     
     dbPath = os.path.expanduser(os.path.join("~", "cache.sqlite3"))
     exists = os.path.exists(dbPath)
-    dbConn = sqlite3.connect(dbPath)
+    dbConn = sqlite3.connect(dbPath, check_same_thread=False)
     cursor = dbConn.cursor()
     
     if not exists:
         cursor.execute("create table fp (path text, result text)")
         cursor.execute("create table mb (url text, result text)")
+    cursor.execute("create table if not exists manifest (path text primary key, "
+                   "signature text, outcome text, time real)")
         
 def saveCacheDB():
     if dbConn:
-        dbConn.commit()
+        with dbLock:
+            dbConn.commit()
+
+def waitForMB():
+    """Sleep until at least one second has passed since the last MB request."""
+    
+    with mbLock:
+        wait = lastMBRequest[0] + 1 - time()
+        if wait > 0:
+            sleep(wait)
+        lastMBRequest[0] = time()
 
         
 def memoizeFP(fn):
     global dbConn, cursor
     
     def dbMemoizedFunction(path):
-        cursor.execute("select result from fp where path=?", (path,))
-        result = cursor.fetchone()
+        with dbLock:
+            cursor.execute("select result from fp where path=?", (path,))
+            result = cursor.fetchone()
         
         if result:
             return json.loads(result[0])
         else:
             result = fn(path)
-            cursor.execute("insert into fp values (?, ?)", (path, json.dumps(result)))
+            with dbLock:
+                cursor.execute("insert into fp values (?, ?)", 
+                               (path, json.dumps(result)))
             return result
         
     # This dispatch function is necessary because the status of the database
@@ -81,6 +105,7 @@ def memoizeMB(fn):
             text = cache[url]
         else:
             #log("Missed MusicBrainz cache (%s)." % stats)
+            waitForMB()
             result = fn(self, url)
             text = result.read()
             cache[url] = text
@@ -88,8 +113,9 @@ def memoizeMB(fn):
     
     def dbMemoizedFunction(self, url):
         stats.calls += 1
-        cursor.execute("select result from mb where url=?", (toUnicode(url),))
-        result = cursor.fetchone()
+        with dbLock:
+            cursor.execute("select result from mb where url=?", (toUnicode(url),))
+            result = cursor.fetchone()
         
         if result:
             stats.hits += 1
@@ -97,10 +123,12 @@ def memoizeMB(fn):
             text = result[0].encode("UTF-8")
         else:
             #log("Missed MusicBrainz DB cache (%s)." % stats)
-            sleep(1)
+            waitForMB()
             result = fn(self, url)
             text = result.read()
-            cursor.execute("insert into mb values (?, ?)", (toUnicode(url), toUnicode(text)))
+            with dbLock:
+                cursor.execute("insert into mb values (?, ?)", 
+                               (toUnicode(url), toUnicode(text)))
         return StringIO.StringIO(text)   # fn must return a file-like object
     
     # This dispatch function is necessary because the status of the database
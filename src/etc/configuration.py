@@ -29,6 +29,7 @@ displaying; and multiple audio encoding qualities on a scale of 1 to 10."""
 
 import pickle
 import platform
+import multiprocessing
 
 import functions
 
@@ -37,15 +38,22 @@ acoustidUserKey = "GlVp11l7"
 
 LOCAL_OS = platform.system()
 
+try:
+    CPU_COUNT = multiprocessing.cpu_count()
+except NotImplementedError:
+    CPU_COUNT = 1
+
 if LOCAL_OS == "Windows":
     configFileName = "audiolog.conf"
 else:
     configFileName = ".audiolog"
 
 # Types to Extensions
-typeToExts = {"archive"   : [".zip", ".rar", ".tar", ".gz", ".bz2", ".ace", ".7z"],
-              "good_audio": [".ogg", ".mp3"],
-              "bad_audio" : [".ape", ".flac", ".wav", ".mpc", ".wv"],
+typeToExts = {"archive"   : [".zip", ".rar", ".tar", ".gz", ".bz2", ".ace", ".7z"] +
+                             [".r%02d" % n for n in range(100)],    # Rar volumes
+              "good_audio": [".ogg", ".mp3", ".flac"],
+              "bad_audio" : [".ape", ".wav", ".mpc", ".wv",
+                             ".opus", ".m4a"],   # Good if tagging can tag them
               "image"     : [".jpg", ".jpeg", ".png", ".bmp"], 
               "cue"       : [".cue"]}
 
@@ -55,6 +63,15 @@ for fileType in typeToExts:
     for extension in typeToExts[fileType]:
         extToType[extension] = fileType
 
+def setFileType(extension, fileType):
+    """Move the extension to fileType in typeToExts and extToType."""
+    
+    for extensions in typeToExts.values():
+        if extension in extensions:
+            extensions.remove(extension)
+    typeToExts[fileType].append(extension)
+    extToType[extension] = fileType
+
 # Paths
 PATHS = {
     "SORTED"  : functions.getDefaultSortedPath(LOCAL_OS),
@@ -64,8 +81,34 @@ PATHS = {
 
 # Settings
 SETTINGS = {
-    "DELETE"   : False,
-    "GET_PRINT": True
+    "DELETE"            : False,
+    "GET_PRINT"         : True,
+    "TAG_PADDING"       : 4096,     # Bytes reserved after tags when a file grows
+    "READ_AHEAD_THREADS": 4,        # Threads loading tags before they're needed
+    "GETTER_THREADS"    : 4,        # Threads calling Finders' getters
+    "CONVERT_WORKERS"   : CPU_COUNT,# Files converted at the same time
+    "EXTRACT_WORKERS"   : 2,        # Archives extracted at the same time
+    "DIRECTORY_WORKERS" : 1,        # Directories handled at the same time
+    "PIPELINE"          : False,    # Handle directories in overlapping stages
+    "STAGE_WORKERS"     : {"prepare"    : 1,    # Threads for each stage
+                           "convert"    : 2,
+                           "split"      : 1,
+                           "fingerprint": 1,
+                           "identify"   : 4,
+                           "tag"        : 2,
+                           "move"       : 1},
+    "STAGE_QUEUE_SIZE"  : 2,        # Directories waiting between stages
+    "INCREMENTAL"       : False,    # Skip directories unchanged since last run
+    "ORGANIZE"          : False,    # Link into SORTED, leaving TO_SCAN untouched
+    "JOURNAL"           : True,     # Record progress so stopped runs can resume
+    "WATCH_SETTLE_SECONDS": 60,     # Quiet time before a new arrival is handled
+    "WATCH_POLL_SECONDS": 10,       # How often to look for changes without inotify
+    "MOVE_THREADS"      : 4,        # Files copied at once between filesystems
+    "VERIFY_MOVES"      : "size",   # Check copies by "size" or "checksum"
+    "SAMPLE_ABOVE"      : None,     # Sample releases with more tracks than
+                                    # this (None: never sample)
+    "SAMPLE_SIZE"       : 4,        # Tracks release Finders ask about first
+    "SAMPLE_POLICY"     : "spread"  # Which tracks: "spread", "first" or "random"
 }
 
 # Traverse Actions
@@ -88,8 +131,6 @@ ENCODING_QUALITY = {
 def loadConfigFile():
     """Unserialize the configuration at fileName and return it."""
     
-    global ACTIONS, SETTINGS, PATHS
-
     try:
         f = open(configFileName, "r")
     except: # File probably doesn't exist yet.
@@ -98,9 +139,11 @@ def loadConfigFile():
     config = pickle.load(f)
     f.close()
     
-    ACTIONS = config["ACTIONS"]
-    SETTINGS = config["SETTINGS"]
-    PATHS = config["PATHS"]
+    # Update rather than replace so that settings added since the file was 
+    # saved keep their defaults.
+    ACTIONS.update(config["ACTIONS"])
+    SETTINGS.update(config["SETTINGS"])
+    PATHS.update(config["PATHS"])
     
     return True
    
@@ -25,12 +25,20 @@ present: moving functions (such as acceptItem, rejectItem and deleteItem) and
 path functions (such as validatePath and getFilePathsByType)."""
 
 import os
+import errno
 import shutil
 import subprocess
 import string
 import datetime
+from math import log10
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
 
 import configuration as conf
+import transfer
 from utils import *
 from logger import log, logfn, logSection
 
@@ -57,15 +65,18 @@ def moveWithContext(currentItemPath, destDirectoryPath):
                                           destDirectoryPath)
     newDirectoryPath = os.path.dirname(newItemPath)
     
-    if not os.path.exists(newDirectoryPath):
-        os.makedirs(newDirectoryPath)
+    makeDirs(newDirectoryPath)
     
-    if not os.path.exists(newItemPath):
-        log("Moving to %s." % quote(newItemPath))
-        shutil.move(currentItemPath, newItemPath)
+    try:
+        transfer.move(currentItemPath, newItemPath)
+    except EnvironmentError, e:
+        if e.errno == errno.EEXIST:
+            log("Could not move. Destination %s already exists." % 
+                quote(newItemPath))
+        else:
+            log("Could not move: %s" % e)
     else:
-        log("Could not move. Destination %s already exists." % 
-            quote(newItemPath))
+        log("Moved to %s." % quote(newItemPath))
     
     removeDirIfEmpty(os.path.dirname(currentItemPath))
     
@@ -76,28 +87,60 @@ def acceptItem(itemPath, destDirectoryRelPath):
     Parameters:
         itemPath can point to a file or directory.
         destDirectoryRelPath is a path relative to the SORTED directory.
-        depth is provided only when the function recursively calls itself."""
+        depth is provided only when the function recursively calls itself.
+        
+    A directory is renamed to the destination in one step when possible (see
+    renameDirectory). Otherwise the files inside it and its subdirectories are
+    all moved into the destination directory, several at a time if they have
+    to be copied to another filesystem (see etc.transfer)."""
 
-    # Create destination directory
     destDirectoryPath = os.path.join(conf.PATHS["SORTED"], destDirectoryRelPath)
-    if not os.path.exists(destDirectoryPath):
-        os.makedirs(destDirectoryPath)
+    if os.path.isdir(itemPath) and renameDirectory(itemPath, destDirectoryPath):
+        return
+    
+    # Create destination directory
+    makeDirs(destDirectoryPath)
     
     if os.path.isdir(itemPath):                         # Directory
-        # Recursively accept items in this directory.
-        for itemName in os.listdir(unicode(itemPath)):
-            acceptItem(os.path.join(itemPath, itemName), destDirectoryRelPath)  
-        removeDirIfEmpty(itemPath)
-
+        filePaths = [os.path.join(dirPath, fileName) for dirPath, dirNames, 
+                     fileNames in os.walk(unicode(itemPath))
+                     for fileName in fileNames]
     else:                                               # File
-        itemName = os.path.basename(itemPath)
-        log("Moving %s into %s." % (quote(itemName), quote(destDirectoryPath)))
-        try:
-            shutil.move(itemPath, destDirectoryPath)
-        except:
-            log("Move failed.")
+        filePaths = [itemPath]
+    
+    filePairs = []
+    for filePath in filePaths:
+        fileName = os.path.basename(filePath)
+        log("Moving %s into %s." % (quote(fileName), quote(destDirectoryPath)))
+        filePairs.append((filePath, os.path.join(destDirectoryPath, fileName)))
+    transfer.moveFiles(filePairs)
+    
+    if os.path.isdir(itemPath):
+        for dirPath, dirNames, fileNames in list(os.walk(itemPath))[::-1]:
+            removeDirIfEmpty(dirPath)
 
 
+def renameDirectory(directoryPath, destDirectoryPath):
+    """Move a directory with a single rename if possible; return True if moved.
+    
+    This is only possible if the destination does not exist yet and is on 
+    the same filesystem, and the directory has no subdirectories (whose 
+    contents acceptItem would move into the destination directory itself)."""
+    
+    for name, isDirectory, isFile in listDirectory(directoryPath):
+        if isDirectory:
+            return False
+        
+    makeDirs(os.path.dirname(destDirectoryPath))
+    try:
+        if not transfer.rename(directoryPath, destDirectoryPath):
+            return False
+    except OSError:
+        return False
+        
+    log("Moving %s to %s." % (quote(directoryPath), quote(destDirectoryPath)))
+    return True
+
 @logfn("Rejecting {quote(itemPath)}.")
 def rejectItem(itemPath):
     """Move a file or directory to the REJECTS folder."""
@@ -166,31 +209,116 @@ def deleteItems(itemPaths, actuallyDelete=None):
 # Path functions
 #-------------------------------------------
 
+class Inventory(object):
+    """The subdirectories and the files (by type) found in one directory.
+    
+    The directory is listed once, with scandir if it is installed. scandir 
+    reports whether each entry is a file or a directory along with its name, 
+    so unlike listing the directory with os.listdir and then calling 
+    os.path.isdir and os.path.isfile on every entry, this needs no further 
+    trips to the disk (or, on a network share, to the server).
+    
+    Subdirectories exclude Audiolog system folders (rejects and deletes) that
+    we should not attempt to traverse and sort."""
+    
+    def __init__(self, directoryPath):
+        """List the directory; raises OSError if it can't be listed."""
+        
+        self.directoryPath = directoryPath
+        self.scan()
+        
+    def scan(self):
+        """List the directory (again)."""
+        
+        self.subdirectoryPaths = []
+        self.filePathsByType = {}
+        for name, isDirectory, isFile in sorted(listDirectory(self.directoryPath)):
+            itemPath = os.path.join(self.directoryPath, toUnicode(name))
+            if isDirectory:
+                if "Audiolog_" not in itemPath:
+                    self.subdirectoryPaths.append(itemPath)
+            elif isFile:
+                fileType = conf.extToType.get(ext(name), "other")
+                self.filePathsByType.setdefault(fileType, []).append(itemPath)
+
+    def update(self, createdPaths, removedPaths):
+        """Account for items created and removed since the directory was listed.
+        
+        This saves listing the directory again after a step which reports what
+        it changed. Returns the paths of any new subdirectories."""
+        
+        for itemPath in removedPaths:
+            if itemPath == self.directoryPath:
+                self.subdirectoryPaths = []
+                self.filePathsByType = {}
+                return []
+            if itemPath in self.subdirectoryPaths:
+                self.subdirectoryPaths.remove(itemPath)
+            for filePaths in self.filePathsByType.values():
+                if itemPath in filePaths:
+                    filePaths.remove(itemPath)
+        for fileType, filePaths in self.filePathsByType.items():
+            if not filePaths:
+                del self.filePathsByType[fileType]
+        
+        newSubdirectoryPaths = []
+        for itemPath in createdPaths:
+            if os.path.dirname(itemPath) != self.directoryPath:
+                continue
+            if os.path.isdir(itemPath):
+                if ("Audiolog_" not in itemPath 
+                    and itemPath not in self.subdirectoryPaths):
+                    newSubdirectoryPaths.append(itemPath)
+            elif os.path.isfile(itemPath):
+                fileType = conf.extToType.get(ext(itemPath), "other")
+                filePaths = self.filePathsByType.setdefault(fileType, [])
+                if itemPath not in filePaths:
+                    filePaths.append(itemPath)
+                    filePaths.sort()
+        self.subdirectoryPaths = sorted(self.subdirectoryPaths + 
+                                        newSubdirectoryPaths)
+        return newSubdirectoryPaths
+
+def listDirectory(directoryPath):
+    """Yield (name, isDirectory, isFile) for each entry in the directory."""
+    
+    if scandir:
+        for entry in scandir(directoryPath):
+            yield entry.name, entry.is_dir(), entry.is_file()
+    else:
+        for name in os.listdir(directoryPath):
+            itemPath = os.path.join(directoryPath, name)
+            yield name, os.path.isdir(itemPath), os.path.isfile(itemPath)
+
+def getInventory(directoryPath):
+    """Return an Inventory of the directory, or None if it can't be listed.
+    
+    This takes the place of validatePath(directoryPath, isDirectory=True), 
+    logging the same messages if the directory is not valid."""
+    
+    try:
+        return Inventory(directoryPath)
+    except OSError, e:
+        if e.errno == errno.ENOTDIR:
+            log(quote(directoryPath) + " is not a directory.")
+        else:
+            log(quote(directoryPath) + " does not exist or cannot be accessed.")
+        return None
+
 def getValidSubdirectories(directoryPath):
     """Return a list paths to directories inside the given directory.
     
     This function filters out Audiolog system folders (rejects and deletes)
     that we should not attempt to traverse and sort."""
     
-    paths = sorted([os.path.join(directoryPath, toUnicode(name)) 
-                    for name in os.listdir(directoryPath)])
-    return [path for path in paths 
-            if (os.path.isdir(path) and "Audiolog_" not in path)]
+    return Inventory(directoryPath).subdirectoryPaths
     
 
 def getFilePathsByType(directoryPath):
-    """Return a list of subdirectory paths and a dict of file paths by type."""
+    """Return a dict of the paths of the files in the directory by type."""
     
-    if not validatePath(directoryPath, isDirectory=True):
-        return {}
-
-    filePathsByType = {}
-    for entry in sorted(os.listdir(directoryPath)):
-        itemPath = os.path.join(directoryPath, toUnicode(entry))
-        if os.path.isfile(itemPath):
-            fileType = conf.extToType.get(ext(entry), "other")
-            filePathsByType.setdefault(fileType, []).append(itemPath)     
-    return filePathsByType
+    inventory = getInventory(directoryPath)
+    return inventory.filePathsByType if inventory else {}
 
 def validatePath(itemPath, isDirectory=False, isFile=False):
     """Ensure the path exists and, if specified, is a file or directory."""
@@ -241,18 +369,20 @@ def moveDiscsIntoFolders(discContents):
     
     Takes a list of lists of paths. Each sublist contains the paths of the
     files that should be moved into that disc directory. The lists should be
-    in order."""
+    in order. Returns the paths of the disc directories."""
 
     directoryPath = os.path.dirname(discContents[0][0])
     numDiscs = len(discContents)
     numDigits = int(log10(numDiscs)+1)  # In case there are 10 (or more) discs
     
+    discDirectoryPaths = []
     for i in range(numDiscs):
         # Create disc directory
         discDirectoryName = "Disc " + str(i+1).zfill(numDigits)
         discDirectoryPath = os.path.join(directoryPath, discDirectoryName)
         log("Creating %s." % quote(discDirectoryPath))
         os.mkdir(discDirectoryPath)
+        discDirectoryPaths.append(discDirectoryPath)
         
         # Move files into disc directory
         for filePath in discContents[i]:
@@ -260,6 +390,20 @@ def moveDiscsIntoFolders(discContents):
             log("Moving %s to %s." % (quote(filePath), quote(newFilePath)))
             shutil.move(filePath, newFilePath)
             
+    return discDirectoryPaths
+            
+def makeDirs(directoryPath):
+    """Create the directory and any missing parents unless it already exists.
+    
+    Unlike os.makedirs this does not fail if another thread creates the 
+    directory first."""
+    
+    try:
+        os.makedirs(directoryPath)
+    except OSError, e:
+        if e.errno != errno.EEXIST or not os.path.isdir(directoryPath):
+            raise
+
 def removeDirIfEmpty(dirPath):
     """Delete the directory if it's empty."""
     
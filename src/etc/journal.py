@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A journal of how far each directory has got, so interrupted runs can resume.
+
+Before a step's results are relied on, a line describing them is appended to 
+the journal file and flushed to disk. The records are:
+
+  extract, convert, split -- an archive, file or cue/audio pair was handled
+                             and its output is in place; its inputs, which are
+                             about to be removed, are listed with their sizes
+                             and modification times
+  identify                -- the metadata found for the release and each track
+  tag                     -- a track's tags and filename have been written
+  move                    -- the release is about to be moved out of place
+  done                    -- nothing more needs doing with the directory
+
+When a run is stopped or crashes, the next run reads the journal (see load)
+and picks up each unfinished directory from its last record: inputs whose
+removal was interrupted are removed (see finishedInputs) unless another file
+has since taken their place, and a release that was 
+identified is not identified again, nor are tracks already written rewritten
+(see metadata.Manager.ReleaseManager.resume). 
+
+Directories which are done are dropped when the journal is next loaded, so it 
+only ever holds the unfinished ones. Set configuration.SETTINGS["JOURNAL"] to
+False to do without it."""
+
+import os
+import json
+import threading
+
+import configuration
+from utils import toUnicode
+from logger import log
+
+JOURNAL_PATH = os.path.expanduser(os.path.join("~", ".audiolog_journal"))
+
+INPUT_STAGES = ("extract", "convert", "split")
+
+# Entries of unfinished directories, by path. See apply for their contents.
+entries = {}
+journalFile = None
+journalLock = threading.Lock()
+
+def apply(record):
+    """Update the entries with a record read from or written to the journal."""
+    
+    path = record["path"]
+    stage = record["stage"]
+    if stage == "done":
+        entries.pop(path, None)
+        return
+    entry = entries.setdefault(path, {})
+    if stage in INPUT_STAGES:
+        entry.setdefault("inputs", []).extend(record["inputs"])
+    elif stage == "identify":
+        entry["identify"] = {"release": record["release"], 
+                             "tracks": record["tracks"]}
+        entry["tag"] = {}
+    elif stage == "tag":
+        entry.setdefault("tag", {})[record["track"]] = record["newPath"]
+    elif stage == "move":
+        entry["move"] = record["destination"]
+
+def load():
+    """Read the journal left by earlier runs and start appending to it.
+    
+    The journal is rewritten to hold just the unfinished directories. A last 
+    line cut short by a crash is ignored."""
+    
+    global journalFile
+    
+    with journalLock:
+        entries.clear()
+        if not configuration.SETTINGS["JOURNAL"]:
+            return
+        if os.path.exists(JOURNAL_PATH):
+            with open(JOURNAL_PATH) as f:
+                for line in f:
+                    try:
+                        apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        break
+        if entries:
+            log("Resuming %d directories left unfinished by an earlier run." % 
+                len(entries))
+        
+        if journalFile:
+            journalFile.close()
+        tempPath = JOURNAL_PATH + ".new"
+        with open(tempPath, "w") as f:
+            for path, entry in entries.items():
+                for record in recordsFor(path, entry):
+                    f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tempPath, JOURNAL_PATH)
+        journalFile = open(JOURNAL_PATH, "a")
+
+def recordsFor(path, entry):
+    """Return the records which, applied in order, recreate an entry."""
+    
+    records = []
+    if entry.get("inputs"):
+        records.append({"path": path, "stage": "extract", 
+                        "inputs": entry["inputs"]})
+    if "identify" in entry:
+        records.append(dict(entry["identify"], path=path, stage="identify"))
+    for track, newPath in entry.get("tag", {}).items():
+        records.append({"path": path, "stage": "tag", "track": track, 
+                        "newPath": newPath})
+    if "move" in entry:
+        records.append({"path": path, "stage": "move", 
+                        "destination": entry["move"]})
+    return records
+
+def record(directoryPath, stage, **details):
+    """Write a record to the journal and wait until it is on disk.
+    
+    The inputs of the extract, convert and split records are given as paths;
+    they are recorded as [path, size, modification time]."""
+    
+    if not configuration.SETTINGS["JOURNAL"]:
+        return
+    if stage in INPUT_STAGES:
+        details["inputs"] = stampInputs(details["inputs"])
+    record = dict(details, path=toUnicode(directoryPath), stage=stage)
+    with journalLock:
+        apply(record)
+        if journalFile:
+            journalFile.write(json.dumps(record) + "\n")
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+
+def stampInputs(inputPaths):
+    """Return [path, size, modification time] for each input that exists."""
+    
+    stamped = []
+    for inputPath in inputPaths:
+        try:
+            stat = os.stat(inputPath)
+        except OSError:
+            continue
+        stamped.append([toUnicode(inputPath), stat.st_size, stat.st_mtime])
+    return stamped
+
+def finishedInputs(directoryPath):
+    """Return the paths of the directory's recorded inputs which are still there.
+    
+    Only files with the size and modification time they had when they were 
+    recorded are returned, so that a new file given the name of one (after a 
+    crash, say) is not mistaken for it and removed."""
+    
+    inputPaths = []
+    for inputPath, size, mtime in getEntry(directoryPath).get("inputs", []):
+        try:
+            stat = os.stat(inputPath)
+        except OSError:
+            continue
+        if stat.st_size == size and stat.st_mtime == mtime:
+            inputPaths.append(inputPath)
+    return inputPaths
+
+def finish(directoryPath):
+    """Record that nothing more needs doing with the directory."""
+    
+    with journalLock:
+        isUnfinished = toUnicode(directoryPath) in entries
+    if isUnfinished:
+        record(directoryPath, "done")
+
+def getEntry(directoryPath):
+    """Return what the journal says about an unfinished directory.
+    
+    The entry is a dict which may have these keys:
+        inputs   -- [path, size, modification time] of files that steps had 
+                    finished with, to be removed (see finishedInputs)
+        identify -- {"release": metadata, "tracks": {path: metadata}}
+        tag      -- {original path: new path} of the tracks written
+        move     -- the path in SORTED the release was being moved to"""
+    
+    with journalLock:
+        return dict(entries.get(toUnicode(directoryPath), {}))
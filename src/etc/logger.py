@@ -19,6 +19,7 @@
 
 import re
 import sys
+import threading
 from functools import wraps
 from contextlib import contextmanager
 
@@ -55,20 +56,64 @@ class GUILogWriter(object):
         pass
 
 class Logger(object):
-    """Write nested log messages to a set of file-like outputs."""
+    """Write nested log messages to a set of file-like outputs.
+    
+    Each thread keeps its own nesting level. A thread doing work on behalf of
+    another (see etc.workers) can capture what it logs with capture(); the 
+    other thread later writes the captured messages out with replay(), nested
+    under its own current level, so that concurrent work still produces a log
+    that reads as if it happened in order."""
     
     def __init__(self):
-        self.level = 0
+        self.local = threading.local()
+        self.lock = threading.RLock()
         self.outputs = []
         self.indent = "    "
         
+    def getLevel(self):
+        return getattr(self.local, "level", 0)
+    
+    def setLevel(self, level):
+        self.local.level = level
+        
+    level = property(getLevel, setLevel)
+        
     def log(self, msg):
-        indent = self.indent * self.level
+        captured = getattr(self.local, "captured", None)
+        if captured is not None:
+            captured.append((self.level, msg))
+        else:
+            self.write(self.level, msg)
+            
+    def write(self, level, msg):
+        indent = self.indent * level
         newlines, content = splitLeadingNewlines(msg)
         result = newlines + indent + content + "\n"
 
-        for output in self.outputs:
-            output.write(toUnicode(result).encode("UTF-8"))
+        with self.lock:
+            for output in self.outputs:
+                output.write(toUnicode(result).encode("UTF-8"))
+                
+    @contextmanager
+    def capture(self):
+        """Collect this thread's messages into a list instead of writing them."""
+        
+        previous = getattr(self.local, "captured", None), self.level
+        self.local.captured = captured = []
+        self.level = 0
+        try:
+            yield captured
+        finally:
+            self.local.captured, self.level = previous
+            
+    def replay(self, captured):
+        """Log messages collected by capture() below the current level."""
+        
+        for level, msg in captured:
+            if getattr(self.local, "captured", None) is not None:
+                self.local.captured.append((self.level + level, msg))
+            else:
+                self.write(self.level + level, msg)
                 
     def startSection(self):
         self.level += 1
@@ -90,8 +135,10 @@ log = logger.log
 closeLog = logger.close
 startLogSection = logger.startSection
 endLogSection = logger.endSection
+captureLog = logger.capture
+replayLog = logger.replay
 logOutputs = logger.outputs
-emitter = logger.outputs[0].emitter
+emitter = logger.outputs[0].emitter if gui else None
 
 
 # The two following functions both provide syntatic sugar for implicitly 
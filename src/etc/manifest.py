@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A record of the directories handled in earlier runs, for incremental runs.
+
+When configuration.SETTINGS["INCREMENTAL"] is set, each directory left in 
+place after it has been handled is recorded along with a signature of its 
+contents: the names, sizes and modification times of its files, the 
+signatures of its subdirectories and the settings that affect how it was 
+handled. On the next run a directory whose signature is unchanged would be 
+handled exactly as before, so it (and everything inside it) is skipped. 
+
+The manifest is kept in a table of the cache database (see etc.cache), which
+creates the table when it is loaded."""
+
+import os
+import json
+import hashlib
+from time import time
+
+import cache
+import configuration
+from functions import Inventory
+from utils import toUnicode
+
+def settingsSignature():
+    """Return a string describing the settings which affect handling."""
+    
+    return json.dumps([sorted(configuration.ACTIONS.items()),
+                       sorted(configuration.ENCODING_QUALITY.items()),
+                       configuration.SETTINGS["DELETE"],
+                       configuration.SETTINGS["GET_PRINT"],
+                       toUnicode(configuration.PATHS["SORTED"])])
+
+def directorySignature(inventory, subdirectorySignatures):
+    """Return the signature of a directory.
+    
+    Takes the directory's Inventory and a list of (name, signature) for the
+    subdirectories. The files are stat'ed for their sizes and times."""
+    
+    files = []
+    for filePaths in inventory.filePathsByType.values():
+        for filePath in filePaths:
+            try:
+                stat = os.stat(filePath)
+            except OSError:
+                continue
+            files.append((toUnicode(os.path.basename(filePath)), 
+                          stat.st_size, stat.st_mtime))
+    files.sort()
+    
+    signature = hashlib.sha1()
+    signature.update(settingsSignature())
+    signature.update(json.dumps(files))
+    signature.update(json.dumps(sorted(subdirectorySignatures)))
+    return signature.hexdigest()
+
+def isUnchanged(directoryPath, signature):
+    """Return True if the directory was handled with this same signature."""
+    
+    if not cache.dbConn:
+        return False
+    with cache.dbLock:
+        cache.cursor.execute("select signature, outcome from manifest "
+                             "where path=?", (toUnicode(directoryPath),))
+        row = cache.cursor.fetchone()
+    return bool(row) and row[0] == signature and row[1] == "handled"
+
+def getSignature(directoryPath):
+    """Return the recorded signature of the directory, or None."""
+    
+    with cache.dbLock:
+        cache.cursor.execute("select signature from manifest where path=?", 
+                             (toUnicode(directoryPath),))
+        row = cache.cursor.fetchone()
+    return row[0] if row else None
+
+def subtreeSignature(directoryPath):
+    """Work out the signature of a directory as it is now, or return None.
+    
+    Recorded signatures are used for subdirectories which have been recorded
+    (they are handled, and so recorded, before the directory containing 
+    them)."""
+    
+    try:
+        inventory = Inventory(directoryPath)
+    except OSError:
+        return None
+    
+    subdirectorySignatures = []
+    for subdirectoryPath in inventory.subdirectoryPaths:
+        signature = (getSignature(subdirectoryPath) 
+                     or subtreeSignature(subdirectoryPath))
+        if signature:
+            subdirectorySignatures.append(
+                (toUnicode(os.path.basename(subdirectoryPath)), signature))
+    return directorySignature(inventory, subdirectorySignatures)
+
+def treeSignatures(directoryPath, skipDirectory=None):
+    """Work out the signatures of a directory and every directory in it.
+    
+    Returns a dict of paths to signatures. Unlike subtreeSignature this never
+    uses recorded signatures, so it can be used on trees which are not 
+    changed by handling them (see traverse.organize). Directories which can't
+    be listed, or for which skipDirectory(path) returns True, are left out 
+    along with everything in them."""
+    
+    signatures = {}
+    
+    def walk(path):
+        try:
+            inventory = Inventory(path)
+        except OSError:
+            return None
+        subdirectorySignatures = []
+        for subdirectoryPath in inventory.subdirectoryPaths:
+            if skipDirectory and skipDirectory(subdirectoryPath):
+                continue
+            signature = walk(subdirectoryPath)
+            if signature:
+                subdirectorySignatures.append(
+                    (toUnicode(os.path.basename(subdirectoryPath)), signature))
+        signatures[path] = directorySignature(inventory, subdirectorySignatures)
+        return signatures[path]
+    
+    walk(toUnicode(directoryPath))
+    return signatures
+
+def record(directoryPath, outcome, signature=None):
+    """Record what became of a directory once it has been handled.
+    
+    outcome is "handled" or "failed". signature is worked out if not given.
+    Directories which no longer exist (they were sorted, rejected or deleted)
+    are removed from the manifest."""
+    
+    if not cache.dbConn:
+        return
+    signature = signature or subtreeSignature(directoryPath)
+    with cache.dbLock:
+        cache.cursor.execute("delete from manifest where path=?", 
+                             (toUnicode(directoryPath),))
+        if signature:
+            cache.cursor.execute("insert into manifest values (?, ?, ?, ?)",
+                                 (toUnicode(directoryPath), signature, outcome, 
+                                  time()))
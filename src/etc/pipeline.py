@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A series of stages, each with its own threads, joined by bounded queues.
+
+An item handed to Pipeline.submit passes through the stages one at a time.
+Each stage is a function which takes the item, does its part of the work and
+returns the name of the stage the item should go to next, or None if the item
+is finished. Items only ever move forward, so a full queue can hold up the
+stage feeding it but never the stage it feeds, and the pipeline cannot 
+deadlock. The queue in front of the first stage is unbounded so submitting 
+never blocks. (An item may also be submitted straight to a later stage, which
+can block until that stage's queue has room.)
+
+Because every stage has its own threads, a slow stage (such as waiting on
+MusicBrainz) holds up only the items waiting for that stage; the stages 
+before it keep working on the items behind.
+
+submit returns a Job (see etc.workers) whose result is the item once it is
+finished, or the exception a stage raised. As with a WorkerPool, the messages
+logged by the stages are held back and written when Job.result is called."""
+
+import sys
+import Queue
+import atexit
+import threading
+
+from workers import Job
+from logger import captureLog, startLogSection
+
+class Stage(object):
+    """One step of a Pipeline: a function and the threads which call it."""
+    
+    def __init__(self, name, fn, numWorkers, queueSize=0):
+        self.name = name
+        self.fn = fn
+        self.numWorkers = max(1, numWorkers)
+        self.queue = Queue.Queue(queueSize)
+        self.threads = []
+        
+
+class Pipeline(object):
+    """Stages connected by queues which items pass through in order."""
+    
+    def __init__(self, stages, queueSize):
+        """Take a list of (name, function, number of threads) and a queue size.
+        
+        Items enter at the first stage listed."""
+        
+        self.stages = {}
+        self.order = []
+        for i, (name, fn, numWorkers) in enumerate(stages):
+            stage = Stage(name, fn, numWorkers, queueSize if i else 0)
+            self.stages[name] = stage
+            self.order.append(stage)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = False
+        self.closing = False
+        
+    def submit(self, item, description=None, stageName=None):
+        """Send item into the first stage (or the named one); return its Job.
+        
+        If given, description is logged before everything the stages log about
+        the item, which is nested below it."""
+        
+        job = Job(None, (), {})
+        if description:
+            job.addLogged([(0, description)])
+        self.startWorkers()
+        stage = self.stages[stageName] if stageName else self.order[0]
+        stage.queue.put((job, item))
+        return job
+    
+    def inWorker(self):
+        """Return True if called from one of the stages' threads."""
+        
+        return getattr(self.local, "isWorker", False)
+        
+    def startWorkers(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            atexit.register(self.shutdown)
+            for stage in self.order:
+                for i in range(stage.numWorkers):
+                    thread = threading.Thread(target=self.work, args=(stage,))
+                    thread.daemon = True
+                    thread.start()
+                    stage.threads.append(thread)
+    
+    def shutdown(self):
+        """Drop items waiting in the queues; stop the threads."""
+        
+        self.closing = True
+        for stage in self.order:
+            for thread in stage.threads:
+                try:
+                    stage.queue.put_nowait(None)
+                except Queue.Full:
+                    pass
+        for stage in self.order:
+            for thread in stage.threads:
+                thread.join(1)
+    
+    def work(self, stage):
+        self.local.isWorker = True
+        while True:
+            entry = stage.queue.get()
+            if entry is None or self.closing:
+                return
+            job, item = entry
+            if job.cancelled:
+                job.finish()
+                continue
+            
+            try:
+                with captureLog() as logged:
+                    startLogSection()
+                    try:
+                        nextStageName = stage.fn(item)
+                    finally:
+                        job.addLogged(logged)
+            except:
+                job.finish(excInfo=sys.exc_info())
+                continue
+                
+            if nextStageName:
+                self.stages[nextStageName].queue.put((job, item))
+            else:
+                job.finish(item)
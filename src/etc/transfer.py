@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Moving files and directories, including between filesystems.
+
+Within a filesystem a move is a rename, which costs next to nothing however big
+the files are. Between filesystems every byte has to be copied and the source
+deleted, which is where all the time goes when SORTED is on another disk than
+the folder being scanned. This module does those copies:
+
+  - in the kernel (copy_file_range, or sendfile) where the platform has it, so
+    the data does not pass through Python's buffers,
+  - several files at a time, in a pool of MOVE_THREADS threads shared by every
+    caller, so the number of copies going on at once stays bounded however many
+    directories are being handled,
+  - checking each copy by size or checksum (VERIFY_MOVES) before deleting the
+    source, and
+  - logging how much was moved and how fast.
+
+Unlike shutil.move, a move never replaces an existing destination.
+
+For configuration.SETTINGS["ORGANIZE"] mode, linkTree gives a tree of files a
+second set of names by hard-linking them, and unshare gives a hard-linked file
+its own data just before it is written to. Both prefer reflinks (copies which
+share their data with the original until either is changed) to real copies 
+where the filesystem supports them."""
+
+import os
+import sys
+import time
+import errno
+import shutil
+import hashlib
+import threading
+
+import configuration as conf
+from workers import WorkerPool
+from utils import quote
+from logger import log
+
+BUFFER_SIZE = 1024 * 1024
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+copyFileRange = sendfile = None
+if ctypes and sys.platform.startswith("linux"):
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        libc = None
+    if libc and hasattr(libc, "copy_file_range"):
+        copyFileRange = libc.copy_file_range
+        copyFileRange.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, 
+                                  ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        copyFileRange.restype = ctypes.c_ssize_t
+    if libc and hasattr(libc, "sendfile"):
+        sendfile = libc.sendfile
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, 
+                             ctypes.c_size_t]
+        sendfile.restype = ctypes.c_ssize_t
+
+FICLONE = 0x40049409     # Linux ioctl which makes a reflink
+
+# Checking that a destination is free and renaming onto it are done while
+# holding this lock, since a rename would silently replace the destination.
+renameLock = threading.Lock()
+
+copyPool = None
+copyPoolLock = threading.Lock()
+
+def getCopyPool():
+    """Return the pool which copies files, creating it if necessary."""
+    
+    global copyPool
+    with copyPoolLock:
+        if not copyPool:
+            copyPool = WorkerPool(conf.SETTINGS["MOVE_THREADS"])
+    return copyPool
+
+def move(sourcePath, destPath):
+    """Move a file or directory to destPath, which must not exist yet."""
+    
+    if os.path.isdir(sourcePath) and not os.path.islink(sourcePath):
+        if rename(sourcePath, destPath):
+            return
+        filePairs = []
+        for dirPath, dirNames, fileNames in os.walk(sourcePath):
+            destDirPath = os.path.normpath(os.path.join(destPath, 
+                                       os.path.relpath(dirPath, sourcePath)))
+            os.mkdir(destDirPath)
+            filePairs.extend((os.path.join(dirPath, fileName), 
+                              os.path.join(destDirPath, fileName)) 
+                             for fileName in fileNames)
+        failures = moveFiles(filePairs)
+        if failures:
+            raise failures[0][1]
+        for dirPath, dirNames, fileNames in list(os.walk(sourcePath))[::-1]:
+            os.rmdir(dirPath)
+    else:
+        failures = moveFiles([(sourcePath, destPath)])
+        if failures:
+            raise failures[0][1]
+        
+def moveFiles(filePairs):
+    """Move each (sourcePath, destPath) pair of files.
+    
+    Files are renamed where possible and copied in parallel where not. Return 
+    a list of (sourcePath, exception) for the files which could not be moved;
+    those sources are left in place."""
+    
+    failures = []
+    toCopy = []
+    totalBytes = 0
+    for sourcePath, destPath in filePairs:
+        try:
+            if not rename(sourcePath, destPath):
+                totalBytes += os.path.getsize(sourcePath)
+                toCopy.append((sourcePath, destPath))
+        except EnvironmentError, e:
+            log("Could not move %s: %s" % (quote(sourcePath), e))
+            failures.append((sourcePath, e))
+    if not toCopy:
+        return failures
+    
+    startTime = time.time()
+    copiedBytes = 0
+    numCopied = 0
+    jobs = [getCopyPool().submit(copyAndRemove, sourcePath, destPath) 
+            for sourcePath, destPath in toCopy]
+    for (sourcePath, destPath), job in zip(toCopy, jobs):
+        try:
+            copiedBytes += job.result()
+        except EnvironmentError, e:
+            log("Could not move %s: %s" % (quote(sourcePath), e))
+            failures.append((sourcePath, e))
+        else:
+            numCopied += 1
+            log("Copied %s (%s of %s)." % (quote(os.path.basename(sourcePath)), 
+                formatSize(copiedBytes), formatSize(totalBytes)))
+    
+    elapsed = max(time.time() - startTime, 0.001)
+    log("Copied %d files, %s in %.1f seconds (%s/s)." % (numCopied, 
+        formatSize(copiedBytes), elapsed, formatSize(copiedBytes / elapsed)))
+    return failures
+
+def rename(sourcePath, destPath):
+    """Rename sourcePath to destPath; return False if they're on different 
+    filesystems.
+    
+    Raise OSError with errno EEXIST if destPath already exists."""
+    
+    with renameLock:
+        if os.path.lexists(destPath):
+            raise OSError(errno.EEXIST, "Destination already exists", destPath)
+        try:
+            os.rename(sourcePath, destPath)
+        except OSError, e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+    return True
+
+def copyAndRemove(sourcePath, destPath):
+    """Copy a file, check the copy and delete the source; return its size.
+    
+    If anything goes wrong the partial copy is deleted and the source kept."""
+    
+    if os.path.islink(sourcePath):
+        os.symlink(os.readlink(sourcePath), destPath)
+        os.remove(sourcePath)
+        return 0
+    
+    copyFile(sourcePath, destPath)
+    try:
+        verifyCopy(sourcePath, destPath)
+    except:
+        os.remove(destPath)
+        raise
+    
+    size = os.path.getsize(destPath)
+    os.remove(sourcePath)
+    return size
+
+def copyFile(sourcePath, destPath):
+    """Copy a file to destPath, which must not exist, as a reflink if possible.
+    
+    If the copy fails, whatever was written of it is deleted."""
+    
+    # O_EXCL makes creating the destination fail if it exists.
+    destFd = os.open(destPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL | 
+                     getattr(os, "O_BINARY", 0), 0666)
+    try:
+        try:
+            sourceFd = os.open(sourcePath, os.O_RDONLY | 
+                               getattr(os, "O_BINARY", 0))
+            try:
+                if not reflink(sourceFd, destFd):
+                    copyData(sourceFd, destFd)
+            finally:
+                os.close(sourceFd)
+        finally:
+            os.close(destFd)
+        shutil.copystat(sourcePath, destPath)
+    except:
+        os.remove(destPath)
+        raise
+
+def reflink(sourceFd, destFd):
+    """Make the destination share the source's data; return False if the 
+    filesystem (or platform) can't."""
+    
+    if not fcntl or not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(destFd, FICLONE, sourceFd)
+    except IOError:
+        return False
+    return True
+
+def copyData(sourceFd, destFd):
+    """Copy everything from one file descriptor to the other.
+    
+    The kernel is asked to do the copying when possible. If it can't (old 
+    kernels, some filesystems) the copy goes on in userspace from wherever the 
+    kernel left off."""
+    
+    for kernelCopy in (copyFileRange, sendfile):
+        if not kernelCopy:
+            continue
+        while True:
+            if kernelCopy is copyFileRange:
+                copied = kernelCopy(sourceFd, None, destFd, None, BUFFER_SIZE, 0)
+            else:
+                copied = kernelCopy(destFd, sourceFd, None, BUFFER_SIZE)
+            if copied == 0:
+                return
+            if copied < 0:
+                break
+        code = ctypes.get_errno()
+        if code not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL, 
+                        errno.EOPNOTSUPP, errno.ENOTSUP):
+            raise OSError(code, os.strerror(code))
+        
+    while True:
+        data = os.read(sourceFd, BUFFER_SIZE)
+        if not data:
+            return
+        while data:
+            data = data[os.write(destFd, data):]
+
+def verifyCopy(sourcePath, destPath):
+    """Raise IOError unless the copy matches the source, per VERIFY_MOVES."""
+    
+    if os.path.getsize(sourcePath) != os.path.getsize(destPath):
+        raise IOError(errno.EIO, "Copy has the wrong size", destPath)
+    if (conf.SETTINGS["VERIFY_MOVES"] == "checksum" and 
+        checksum(sourcePath) != checksum(destPath)):
+        raise IOError(errno.EIO, "Copy has the wrong checksum", destPath)
+        
+def checksum(filePath):
+    digest = hashlib.md5()
+    with open(filePath, "rb") as f:
+        for block in iter(lambda: f.read(BUFFER_SIZE), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def formatSize(numBytes):
+    """Return a size in bytes as a short string, like "4.2 MB"."""
+    
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if numBytes < 1024:
+            break
+        numBytes /= 1024.0
+    else:
+        unit = "TB"
+    return ("%d %s" if unit == "bytes" else "%.1f %s") % (numBytes, unit)
+
+def linkTree(sourcePath, destPath, skipDirectory=None):
+    """Recreate the tree at sourcePath under destPath, linking every file.
+    
+    Files are hard-linked, so this costs no more than creating the names. 
+    Where that isn't possible (destPath is on another filesystem, or links are
+    not supported) files are reflinked or, failing that, copied. Files already
+    present under destPath are left alone. Directories for which 
+    skipDirectory(path) returns True are left out.
+    
+    Copying can take far longer and use far more space than linking, so the 
+    first time a file has to be copied the reason is logged, and how much was
+    copied is logged at the end."""
+    
+    numCopied = bytesCopied = 0
+    for dirPath, dirNames, fileNames in os.walk(sourcePath):
+        if skipDirectory:
+            dirNames[:] = [dirName for dirName in dirNames if not 
+                           skipDirectory(os.path.join(dirPath, dirName))]
+        destDirPath = os.path.normpath(os.path.join(destPath, 
+                                       os.path.relpath(dirPath, sourcePath)))
+        if not os.path.isdir(destDirPath):
+            os.makedirs(destDirPath)
+        for fileName in fileNames:
+            sourceFilePath = os.path.join(dirPath, fileName)
+            destFilePath = os.path.join(destDirPath, fileName)
+            if os.path.lexists(destFilePath):
+                continue
+            try:
+                os.link(sourceFilePath, destFilePath)
+                continue
+            except (OSError, AttributeError), e:
+                if not numCopied:
+                    log("Could not link %s (%s); copying instead." 
+                        % (quote(sourceFilePath), 
+                           getattr(e, "strerror", None) or e))
+            copyFile(sourceFilePath, destFilePath)
+            numCopied += 1
+            bytesCopied += os.path.getsize(destFilePath)
+    
+    if numCopied:
+        log("Copied %d %s (%s) which could not be linked." 
+            % (numCopied, "file" if numCopied == 1 else "files", 
+               formatSize(bytesCopied)))
+
+def unshare(filePath):
+    """Give a hard-linked file its own data so it can be changed on its own.
+    
+    The file is replaced by a reflink or copy of itself; its other names keep 
+    the original data. Files with no other names are left as they are."""
+    
+    if os.stat(filePath).st_nlink < 2:
+        return
+    dirPath, fileName = os.path.split(filePath)
+    tempPath = os.path.join(dirPath, ".%s.unshared" % fileName)
+    if os.path.lexists(tempPath):
+        os.remove(tempPath)
+    copyFile(filePath, tempPath)
+    os.rename(tempPath, filePath)
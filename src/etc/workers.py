@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A small pool of worker threads for running functions in the background.
+
+A function is handed to WorkerPool.submit, which returns a Job right away. One
+of the pool's threads runs the function and the caller gets its return value
+(or has its exception re-raised) by calling Job.result, which waits for the
+function to finish if it has not yet.
+
+The threads are started the first time something is submitted and live as
+long as the program does, so a pool is normally created once and kept in a
+module-level variable. When the program exits, jobs that have not started yet
+are dropped and the threads are stopped.
+
+Anything a job logs while running on a pool thread is held back and written to
+the log when Job.result is first called, nested under whatever the caller is
+logging at that point. This keeps each job's messages together and in the
+order the caller asks for the results, rather than interleaved.
+
+A function running in a pool may submit more work to the same pool. That work
+is run immediately in the submitting thread instead of being queued, because
+otherwise every worker could end up waiting on jobs that no worker is free to
+run."""
+
+import sys
+import Queue
+import atexit
+import threading
+
+from logger import captureLog, replayLog
+
+class Job(object):
+    """The pending result of a function submitted to a WorkerPool."""
+
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.excInfo = None
+        self.cancelled = False
+        self.logged = []
+        self.callbacks = []
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+
+    def run(self, captureLogged=False):
+        """Call the function, store its outcome and call any callbacks."""
+
+        value = excInfo = None
+        try:
+            if self.cancelled:
+                pass
+            elif captureLogged:
+                with captureLog() as logged:
+                    try:
+                        value = self.fn(*self.args, **self.kwargs)
+                    finally:
+                        self.addLogged(logged)
+            else:
+                value = self.fn(*self.args, **self.kwargs)
+        except:
+            excInfo = sys.exc_info()
+        self.finish(value, excInfo)
+
+    def addLogged(self, logged):
+        """Hold back messages logged on the job's behalf until result is called."""
+        
+        with self.lock:
+            self.logged.extend(logged)
+
+    def finish(self, value=None, excInfo=None):
+        """Store the outcome of the job and call any callbacks.
+        
+        Job.run does this itself; it is only called directly by code which 
+        runs the job's work some other way (see etc.pipeline)."""
+        
+        self.value = value
+        self.excInfo = excInfo
+        with self.lock:
+            self.finished.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def cancel(self):
+        """Keep the function from being called if it has not started yet.
+        
+        A cancelled job still finishes, with a result of None."""
+
+        self.cancelled = True
+
+    def done(self):
+        """Return True if the function has finished running."""
+
+        return self.finished.is_set()
+
+    def addCallback(self, callback):
+        """Call callback(job) when the job finishes (or now, if it has)."""
+
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def result(self):
+        """Wait for the function to finish, then return its result.
+
+        If the function raised an exception, it is raised again here."""
+
+        self.finished.wait()
+        with self.lock:
+            logged, self.logged = self.logged, []
+        replayLog(logged)
+        if self.excInfo:
+            raise self.excInfo[0], self.excInfo[1], self.excInfo[2]
+        return self.value
+
+
+class WorkerPool(object):
+    """A fixed number of threads which run submitted functions."""
+
+    def __init__(self, numWorkers):
+        self.numWorkers = max(1, numWorkers)
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.closing = False
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) to be run; return its Job."""
+
+        job = Job(fn, args, kwargs)
+        if self.inWorker():
+            job.run()
+        else:
+            self.startWorkers()
+            self.queue.put(job)
+        return job
+
+    def map(self, fn, items):
+        """Run fn on each item in parallel; return the results in order."""
+
+        jobs = [self.submit(fn, item) for item in items]
+        return [job.result() for job in jobs]
+
+    def inWorker(self):
+        """Return True if called from one of this pool's threads."""
+
+        return getattr(self.local, "isWorker", False)
+
+    def startWorkers(self):
+        with self.lock:
+            if not self.threads:
+                atexit.register(self.shutdown)
+            while len(self.threads) < self.numWorkers:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def shutdown(self):
+        """Drop jobs that have not started; stop the threads."""
+
+        self.closing = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(1)
+
+    def work(self):
+        self.local.isWorker = True
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            if not self.closing:
+                job.run(captureLogged=True)
@@ -31,6 +31,7 @@ import shutil
 
 from etc import configuration
 from etc import functions
+from etc import transfer
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
@@ -62,7 +63,13 @@ def makeImageCover(imagePath):
     
     dirPath, name = os.path.split(imagePath)
     root, ext = os.path.splitext(name)
-    shutil.move(imagePath, os.path.join(dirPath, "cover" + ext))
+    coverPath = os.path.join(dirPath, "cover" + ext)
+    if coverPath == imagePath:
+        return
+    try:
+        transfer.move(imagePath, coverPath)
+    except EnvironmentError, e:
+        log("Could not rename %s: %s" % (quote(name), e))
         
 @logfn("\nDeleting miscellaneous files.")
 def cleanDir(filePaths):
@@ -124,6 +131,8 @@ def standardizeFilenames(itemPaths, rename=True):
 
 
 def canonicalName(name):
+    pass
+
 """Rules:
 
 ==Featuring==
@@ -20,14 +20,24 @@
 """Audio conversion support for multiple audio formats.
 
 The convert function is called by traverse if audio in an undesirable format
-is found. The currently supported source formats are: wav, flac, ape and mpc.
+is found. The currently supported source formats are: wav, flac, ape, mpc and
+wv, and opus and m4a when the installed Mutagen can't tag them.
 These formats are currently always converted into Ogg Vorbis but MP3 encoding
-support is certain to be a popular demand if we release this publicly."""
+support is certain to be a popular demand if we release this publicly.
+
+Formats which oggenc can't read itself are decoded by another program, whose
+output is piped into oggenc if it can write to a pipe and written to a WAV file
+for oggenc to read otherwise."""
 
 import os
+import time
+import threading
 import subprocess
 
 from etc import functions
+from etc import journal
+from etc.workers import WorkerPool
+from etc.transfer import formatSize
 from etc import configuration as conf
 from etc.utils import *
 from etc.logger import log, logfn, logSection
@@ -40,47 +50,216 @@ convertorCommands = {
     ".mpc" : [['mpc123', '-w', '$$.wav', '$$.mpc'],
               ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), '$$.wav']],
     ".wv"  : [['wvunpack', '$$.wv', '-o', '$$.wav'],
-              ['oggenc', '-q', str(conf.ENCODING_QUALITY["HIGH"]), '$$.wav']]
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["HIGH"]), '$$.wav']],
+    ".opus": [['opusdec', '$$.opus', '$$.wav'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), '$$.wav']],
+    ".m4a" : [['faad', '-o', '$$.wav', '$$.m4a'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), '$$.wav']]
+}
+
+# Formats which oggenc can't read are decoded to WAV. Where the decoder can
+# write the WAV to its stdout, it is piped straight into oggenc instead of 
+# being written to disk and read back. The commands above are the fallback.
+streamingCommands = {
+    ".ape" : [['mac', '$$.ape', '-', '-d'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["HIGH"]), 
+               '-o', '$$.ogg', '-']],
+    ".mpc" : [['mpcdec', '$$.mpc', '-'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), 
+               '-o', '$$.ogg', '-']],
+    ".wv"  : [['wvunpack', '$$.wv', '-o', '-'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["HIGH"]), 
+               '-o', '$$.ogg', '-']],
+    ".opus": [['opusdec', '$$.opus', '-'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), 
+               '-o', '$$.ogg', '-']],
+    ".m4a" : [['faad', '-w', '$$.m4a'],
+              ['oggenc', '-q', str(conf.ENCODING_QUALITY["MEDIUM"]), 
+               '-o', '$$.ogg', '-']]
 }
 
+class ConversionStats(object):
+    """Counts the audio converted during a run and the time spent on it.
+    
+    The time is the time during which at least one file was being converted,
+    so files converted at the same time are not counted twice."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        self.numFiles = 0
+        self.numFailed = 0
+        self.numBytes = 0
+        self.seconds = 0.0
+        self.numActive = 0
+        self.activeSince = None
+        
+    def start(self):
+        with self.lock:
+            if not self.numActive:
+                self.activeSince = time.time()
+            self.numActive += 1
+            
+    def stop(self, numBytes, success):
+        with self.lock:
+            self.numActive -= 1
+            if not self.numActive:
+                self.seconds += time.time() - self.activeSince
+            if success:
+                self.numFiles += 1
+                self.numBytes += numBytes
+            else:
+                self.numFailed += 1
+                
+    def __str__(self):
+        seconds = max(self.seconds, 0.001)
+        summary = ("Converted %d files (%s) in %.1f seconds (%s/s, %.1f files/s)." 
+                   % (self.numFiles, formatSize(self.numBytes), self.seconds, 
+                      formatSize(self.numBytes / seconds), 
+                      self.numFiles / seconds))
+        if self.numFailed:
+            summary += " %d could not be converted." % self.numFailed
+        return summary
+
+stats = ConversionStats()
+
+convertPool = None
+convertPoolLock = threading.Lock()
+
+def getConvertPool():
+    """Return the pool which runs the converters, creating it if necessary."""
+    
+    global convertPool
+    with convertPoolLock:
+        if not convertPool:
+            convertPool = WorkerPool(conf.SETTINGS["CONVERT_WORKERS"])
+    return convertPool
+
 @logfn("\nConverting audio to Ogg.")
 def convert(audioFilePaths):
     """Convert undesirable audio formats into ogg.
     
     Takes a list of audio files and converts each to ogg using appropriate
-    commands. These commands (mac, oggenc, mpc123) must be present."""
+    commands. These commands (mac, oggenc, mpc123) must be present. The files
+    are converted at the same time, as many as there are workers in the 
+    convert pool, which is shared by all the directories being handled.
     
-    for audioFilePath in audioFilePaths:
-        fileName = os.path.basename(audioFilePath)
-        with logSection("Converting %s." % quote(fileName)):
-            filePathWithoutExtension, extension = os.path.splitext(audioFilePath)
-            commands = convertorCommands[extension]
-            
-            success = True
-            for command in commands:
-                cmd = [arg.replace("$$", filePathWithoutExtension)
-                       for arg in command]
-                
-                log(" ".join(cmd))
-                try:
-                    p = subprocess.Popen(cmd)
-                    p.wait()
-                except OSError:
-                    log("% command not found." % cmd[0])
-                    success = False
-                    break
-                
-                if p.returncode != 0:
-                    success = False
-                    break
-            
+    Returns a list of the Ogg files created and a list of the files removed."""
+    
+    jobs = [getConvertPool().submit(convertFile, audioFilePath) 
+            for audioFilePath in audioFilePaths]
+    createdPaths = []
+    for job in jobs:
+        createdPath = job.result()
+        if createdPath:
+            createdPaths.append(createdPath)
+    return createdPaths, list(audioFilePaths)
+
+def convertFile(audioFilePath):
+    """Convert one file; return the path of the Ogg file, or None on failure.
+    
+    On success the original is deleted, otherwise it is rejected."""
+    
+    fileName = os.path.basename(audioFilePath)
+    with logSection("Converting %s." % quote(fileName)):
+        filePathWithoutExtension, extension = os.path.splitext(audioFilePath)
+        commands = convertorCommands[extension]
+        
+        wavPath = filePathWithoutExtension + ".wav"
+        numBytes = os.path.getsize(audioFilePath)
+        stats.start()
+        usedWav = False
+        success = False
+        if extension in streamingCommands:
+            success = stream(filePathWithoutExtension, 
+                             streamingCommands[extension])
             if not success:
-                # FIXME: Should we reject this file or this entire directory?
-                log("Unable to convert %s." % quote(fileName))
-                functions.rejectItem(audioFilePath)
-            else:
-                functions.deleteItem(audioFilePath)
+                log("Could not stream the audio. Decoding it to a WAV file.")
+        if not success:
+            success = runCommands(filePathWithoutExtension, commands)
+            usedWav = len(commands) > 1
+        stats.stop(numBytes, success)
+        
+        createdPath = None
+        if not success:
+            # FIXME: Should we reject this file or this entire directory?
+            log("Unable to convert %s." % quote(fileName))
+            functions.rejectItem(audioFilePath)
+        else:
+            inputs = [audioFilePath]
+            if usedWav:
+                inputs.append(wavPath)
+            journal.record(os.path.dirname(audioFilePath), "convert",
+                           inputs=inputs)
+            functions.deleteItem(audioFilePath)
+            createdPath = filePathWithoutExtension + ".ogg"
+        
+        if usedWav and os.path.exists(wavPath): # If we created an intermediate wav file
+            functions.deleteItem(wavPath, True)
             
-            if len(commands) > 1: # If we created an intermediate wav file
-                functions.deleteItem(filePathWithoutExtension + ".wav", True)
-        
\ No newline at end of file
+    return createdPath
+
+def runCommands(filePathWithoutExtension, commands):
+    """Run the commands one after another; return True if all succeeded."""
+    
+    for command in commands:
+        cmd = [arg.replace("$$", filePathWithoutExtension) for arg in command]
+        
+        log(" ".join(cmd))
+        try:
+            # Other conversions may be running at the same time; close_fds 
+            # keeps the command from inheriting (and holding open) their pipes.
+            p = subprocess.Popen(cmd, close_fds=True)
+            p.wait()
+        except OSError:
+            log("%s command not found." % cmd[0])
+            return False
+        
+        if p.returncode != 0:
+            return False
+    return True
+
+def stream(filePathWithoutExtension, commands):
+    """Pipe a decoder's output into the encoder; return True if both succeeded.
+    
+    If either fails, whatever the encoder wrote is deleted."""
+    
+    decodeCmd, encodeCmd = [[arg.replace("$$", filePathWithoutExtension) 
+                             for arg in command] for command in commands]
+    oggPath = filePathWithoutExtension + ".ogg"
+    
+    log("%s | %s" % (" ".join(decodeCmd), " ".join(encodeCmd)))
+    decoder = encoder = None
+    try:
+        # close_fds is needed (on Python 2) so that neither process inherits
+        # the pipes of other conversions; an encoder whose pipe is held open 
+        # elsewhere never sees the end of its input and never finishes.
+        decoder = subprocess.Popen(decodeCmd, stdout=subprocess.PIPE, 
+                                   close_fds=True)
+        encoder = subprocess.Popen(encodeCmd, stdin=decoder.stdout, 
+                                   close_fds=True)
+    except OSError:
+        log("%s command not found." % (encodeCmd if decoder else decodeCmd)[0])
+        if decoder:
+            decoder.kill()
+            decoder.wait()
+        return False
+    finally:
+        # Only the encoder should hold the read end of the pipe, so that the
+        # decoder is stopped (by SIGPIPE) if the encoder exits early.
+        if decoder:
+            decoder.stdout.close()
+    
+    encoder.wait()
+    decoder.wait()
+    if decoder.returncode != 0 or encoder.returncode != 0:
+        if decoder.returncode != 0:
+            log("%s failed." % decodeCmd[0])
+        if encoder.returncode != 0:
+            log("%s failed." % encodeCmd[0])
+        if os.path.exists(oggPath):
+            os.remove(oggPath)
+        return False
+    return True
@@ -23,60 +23,385 @@ This is file provides one function, extract, which takes a list of archive
 paths and attempts to extract each. This function is called in traverse
 if any archives are found in a directory.
 
-The currently supported formats are: zip, rar, tar, gzip, bzip2, and ace."""
+The currently supported formats are: zip, rar, tar, gzip, bzip2, and ace. 
+Multi-volume rar archives are extracted once, from their first volume. Before
+extracting a zip, rar or uncompressed tar archive its listing is checked, and
+archives with no audio, cues or other archives in them are deleted without 
+being extracted. Listing a compressed tar means decompressing all of it, so 
+those are read once and the result is dropped if nothing of that sort was in
+them.
+
+Zip and tar archives (compressed or not) are read by Python itself, which lets
+us write out only the members that would survive the rest of handling the 
+directory: audio, cues, images and nested archives, and other files only if 
+they are not going to be cleaned away (see wantedTypes). The others are never
+written and, in zip archives, never even decompressed. Members whose paths 
+would put them outside the extraction folder are skipped as well. The other 
+formats, and archives Python can't read, are extracted by external programs."""
 
 import os
+import re
+import time
+import shutil
+import tarfile
+import zipfile
+import threading
 import subprocess
+from collections import OrderedDict
 
 from etc import functions
+from etc import journal
+from etc import configuration
+from etc.workers import WorkerPool
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
 extractorCommands = {".zip": ['unzip', '$a', '-d', '$d'],
                      ".rar": ['unrar', 'x', '$a', '$d'],
-                     ".tar": ['tar', '-xf', '$a', '$d'],
-                     ".gz" : ['tar', '-zxf', '$a', '$d'],
-                     ".bz2": ['tar', '-jxf', '$a', '$d'],
+                     ".tar": ['tar', '-xf', '$a', '-C', '$d'],
+                     ".gz" : ['tar', '-zxf', '$a', '-C', '$d'],
+                     ".bz2": ['tar', '-jxf', '$a', '-C', '$d'],
                      ".ace": ['unace', 'x', '-y', '$a', '$d/']}
 
+# The volumes of multi-volume rar archives
+partPattern = re.compile(r"^(.*)\.part(\d+)\.rar$", re.IGNORECASE)
+volumePattern = re.compile(r"^(.*)\.(rar|r\d\d)$", re.IGNORECASE)
+
+extractPool = None
+extractPoolLock = threading.Lock()
+
+def getExtractPool():
+    """Return the pool which extracts archives, creating it if necessary."""
+    
+    global extractPool
+    with extractPoolLock:
+        if not extractPool:
+            extractPool = WorkerPool(configuration.SETTINGS["EXTRACT_WORKERS"])
+    return extractPool
+
 @logfn("\nExtracting archives.")
 def extract(archivePaths):
     """Extract archives using appropriate utility.
     
-    Takes a list of paths to archives and for each:
+    Takes a list of paths to archives. They are first grouped into sets of 
+    volumes (see groupVolumes) and for each set:
     Creates a directory with the same name as the archive, without extension.
     Chooses the utility to use for extraction based on the archive's extension.
-    Attempts to extract the archive into the newly created directory.
-    If the extraction fails, the directory is deleted and the archive rejected.
-    If the extraction succeeds, the archive is discarded."""
-    
-    for archivePath in archivePaths:
-        fileName = os.path.basename(archivePath)
-        with logSection("Extracting %s." % quote(fileName)):
-            destDirectoryPath, ext = os.path.splitext(archivePath)
-            if not os.path.exists(destDirectoryPath):
-                os.mkdir(destDirectoryPath)   
-            
-            command = extractorCommands[ext.lower()][:]
-            for (i, arg) in enumerate(command):
-                if arg == "$a":
-                    command[i] = archivePath
-                elif arg == "$d":
-                    command[i] = destDirectoryPath
-            
-            log(" ".join(command))
-            
+    Attempts to extract the first volume into the newly created directory.
+    If the extraction fails, the directory is deleted and the volumes rejected.
+    If the extraction succeeds, the volumes are discarded.
+    
+    Sets are extracted at the same time on the extract pool, except that sets
+    which would be extracted into the same directory are done one by one.
+    
+    Returns a list of the directories created and a list of the archives 
+    removed."""
+    
+    setsByDestination = OrderedDict()
+    for volumePaths in groupVolumes(archivePaths):
+        destDirectoryPath = archiveDestination(volumePaths[0])
+        setsByDestination.setdefault(destDirectoryPath, []).append(volumePaths)
+    
+    jobs = [getExtractPool().submit(extractSets, volumeSets) 
+            for volumeSets in setsByDestination.values()]
+    createdPaths = []
+    removedPaths = []
+    for job in jobs:
+        created, removed = job.result()
+        createdPaths.extend(created)
+        removedPaths.extend(removed)
+    return createdPaths, removedPaths
+
+def extractSets(volumeSets):
+    """Extract each set of volumes in turn; return (created, removed) paths."""
+    
+    createdPaths = []
+    removedPaths = []
+    for volumePaths in volumeSets:
+        createdPath = extractSet(volumePaths)
+        if createdPath and createdPath not in createdPaths:
+            createdPaths.append(createdPath)
+        removedPaths.extend(volumePaths)
+    return createdPaths, removedPaths
+
+def extractSet(volumePaths):
+    """Extract an archive from its first volume; return the directory created.
+    
+    Returns None if the extraction failed."""
+    
+    archivePath = volumePaths[0]
+    fileName = os.path.basename(archivePath)
+    with logSection("Extracting %s." % quote(fileName)):
+        if len(volumePaths) > 1:
+            log("This is the first of %d volumes." % len(volumePaths))
+        if not isWorthExtracting(archivePath):
+            log("%s contains no audio, cues or archives." % quote(fileName))
+            functions.deleteItems(volumePaths)
+            return None
+        destDirectoryPath = archiveDestination(archivePath)
+        if not os.path.exists(destDirectoryPath):
+            os.mkdir(destDirectoryPath)   
+        
+        writtenPaths = None
+        if archiveFormat(archivePath) in readers:
+            writtenPaths = readArchive(archivePath, destDirectoryPath)
+            if (writtenPaths is not None and 
+                not any(isSortable(path) for path in writtenPaths)):
+                log("%s contains no audio, cues or archives." % quote(fileName))
+                functions.deleteItem(destDirectoryPath)
+                functions.deleteItems(volumePaths)
+                return None
+        
+        success = writtenPaths is not None
+        if not success:
+            success = runExtractor(archivePath, destDirectoryPath)
+        
+        if not success:
+            log("Unable to extract %s." % quote(archivePath))
+            functions.deleteItem(destDirectoryPath)
+            functions.rejectItems(volumePaths)
+            return None
+        
+        journal.record(os.path.dirname(archivePath), "extract", 
+                       inputs=volumePaths)
+        functions.deleteItems(volumePaths)
+        return destDirectoryPath
+
+def groupVolumes(archivePaths):
+    """Group the volumes of multi-volume archives together.
+    
+    Returns a list of lists of paths, one for each archive, with the volume to
+    extract from first. Rar volumes are recognized in both naming schemes:
+    "name.part01.rar", "name.part02.rar", ... and "name.rar", "name.r00", ...
+    Any other archive is a set of one."""
+    
+    volumeSets = OrderedDict()
+    for archivePath in sorted(archivePaths):
+        match = partPattern.match(archivePath)
+        if match:
+            key = (match.group(1).lower(), "part")
+            order = int(match.group(2))
+        else:
+            match = volumePattern.match(archivePath)
+            if match and match.group(2).lower() == "rar":
+                key = (match.group(1).lower(), "r")
+                order = -1
+            elif match:
+                key = (match.group(1).lower(), "r")
+                order = int(match.group(2)[1:])
+            else:
+                key = (archivePath, None)
+                order = 0
+        volumeSets.setdefault(key, []).append((order, archivePath))
+    return [[archivePath for order, archivePath in sorted(volumes)] 
+            for volumes in volumeSets.values()]
+
+def archiveDestination(archivePath):
+    """Return the directory an archive is extracted into.
+    
+    This is the archive's path without its extension (and, for volumes named
+    "name.part01.rar", without the part number)."""
+    
+    match = partPattern.match(archivePath)
+    if match:
+        return match.group(1)
+    return os.path.splitext(archivePath)[0]
+
+def archiveFormat(archivePath):
+    """Return the extension standing for the archive's format, like ".rar"."""
+    
+    extension = ext(archivePath)
+    if re.match(r"^\.r\d\d$", extension):
+        return ".rar"
+    return extension
+
+def isWorthExtracting(archivePath):
+    """Return False if the archive's listing shows nothing that could be sorted.
+    
+    Only the archive's table of contents is read. If it can't be listed, the
+    archive is assumed to be worth extracting."""
+    
+    memberPaths = listMembers(archivePath)
+    if memberPaths is None:
+        return True
+    return any(isSortable(memberPath) for memberPath in memberPaths)
+
+def isSortable(memberPath):
+    """Return True if the member is audio, a cue or another archive."""
+    
+    fileType = configuration.extToType.get(ext(memberPath), "other")
+    return fileType in ("good_audio", "bad_audio", "cue", "archive")
+
+def listMembers(archivePath):
+    """Return the paths of the files in the archive, or None if unknown.
+    
+    Compressed tars are not listed (None is returned): the whole archive 
+    would have to be decompressed, and then again to extract it."""
+    
+    archiveType = archiveFormat(archivePath)
+    try:
+        if archiveType == ".zip":
+            with zipfile.ZipFile(archivePath) as archive:
+                return [name for name in archive.namelist() 
+                        if not name.endswith("/")]
+        
+        elif archiveType == ".tar":
+            archive = tarfile.open(archivePath, "r:")
             try:
-                p = subprocess.Popen(command)
-                p.wait()
-                success = p.returncode == 0
-            except OSError:
-                log("%s command not found." % command[0])
-                success = False
+                return [member.name for member in archive if member.isfile()]
+            finally:
+                archive.close()
+                
+        elif archiveType == ".rar":
+            p = subprocess.Popen(["unrar", "lb", archivePath], 
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output = p.communicate()[0]
+            if p.returncode == 0:
+                return output.splitlines()
             
-            if not success:
-                log("Unable to extract %s." % quote(archivePath))
-                functions.deleteItem(destDirectoryPath)
-                functions.rejectItem(archivePath)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, tarfile.TarError, 
+            EnvironmentError, EOFError):
+        pass
+    return None
+
+def runExtractor(archivePath, destDirectoryPath):
+    """Extract the archive with an external program; return True on success."""
+    
+    command = extractorCommands[archiveFormat(archivePath)][:]
+    for (i, arg) in enumerate(command):
+        if arg == "$a":
+            command[i] = archivePath
+        elif arg == "$d":
+            command[i] = destDirectoryPath
+    
+    log(" ".join(command))
+    
+    try:
+        p = subprocess.Popen(command)
+        p.wait()
+        return p.returncode == 0
+    except OSError:
+        log("%s command not found." % command[0])
+        return False
+
+def wantedTypes():
+    """Return the file types which handling the directory will not delete."""
+    
+    types = set(configuration.typeToExts)
+    if not configuration.ACTIONS["CLEAN"]:
+        types.add("other")
+    return types
+
+def isWanted(memberPath):
+    """Return True if a member with this path is worth extracting."""
+    
+    fileType = configuration.extToType.get(ext(memberPath), "other")
+    return fileType in wantedTypes()
+
+def memberDestination(destDirectoryPath, memberName):
+    """Return where the member should be written, or None if it's not safe.
+    
+    Absolute paths and paths leading out of the folder with ".." are unsafe."""
+    
+    memberPath = os.path.normpath(toUnicode(memberName).replace("\\", "/"))
+    if (os.path.isabs(memberPath) or memberPath == os.curdir or 
+        memberPath.split(os.sep)[0] == os.pardir):
+        return None
+    destPath = os.path.join(destDirectoryPath, memberPath)
+    realDirectoryPath = os.path.realpath(destDirectoryPath)
+    if not os.path.realpath(destPath).startswith(realDirectoryPath + os.sep):
+        return None
+    return destPath
+
+def writeMember(source, destPath, mtime):
+    """Copy an open member of an archive to destPath."""
+    
+    functions.makeDirs(os.path.dirname(destPath))
+    with open(destPath, "wb") as dest:
+        shutil.copyfileobj(source, dest, 1024 * 1024)
+    os.utime(destPath, (mtime, mtime))
+
+def readZip(archivePath, destDirectoryPath):
+    """Write the wanted members of a zip archive.
+    
+    Returns the paths written and the number of members skipped."""
+    
+    writtenPaths = []
+    skipped = 0
+    with zipfile.ZipFile(archivePath) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith("/"):
+                continue
+            destPath = memberDestination(destDirectoryPath, info.filename)
+            if not destPath:
+                log("Skipping %s; it would be extracted outside %s." % 
+                    (quote(info.filename), quote(destDirectoryPath)))
+            elif not isWanted(destPath):
+                skipped += 1
             else:
-                functions.deleteItem(archivePath)
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                source = archive.open(info)
+                try:
+                    writeMember(source, destPath, mtime)
+                finally:
+                    source.close()
+                writtenPaths.append(destPath)
+    return writtenPaths, skipped
+
+def readTar(archivePath, destDirectoryPath):
+    """Write the wanted members of a tar archive.
+    
+    Returns the paths written and the number of members skipped. Only regular
+    files are written; links and device files are skipped."""
+    
+    writtenPaths = []
+    skipped = 0
+    archive = tarfile.open(archivePath, "r:*")
+    try:
+        for member in archive:
+            if member.isdir():
+                continue
+            destPath = memberDestination(destDirectoryPath, member.name)
+            if not member.isfile():
+                skipped += 1
+            elif not destPath:
+                log("Skipping %s; it would be extracted outside %s." % 
+                    (quote(member.name), quote(destDirectoryPath)))
+            elif not isWanted(destPath):
+                skipped += 1
+            else:
+                source = archive.extractfile(member)
+                try:
+                    writeMember(source, destPath, member.mtime)
+                finally:
+                    source.close()
+                writtenPaths.append(destPath)
+    finally:
+        archive.close()
+    return writtenPaths, skipped
+
+readers = {".zip": readZip,
+           ".tar": readTar,
+           ".gz" : readTar,
+           ".bz2": readTar}
+
+def readArchive(archivePath, destDirectoryPath):
+    """Extract the wanted members of the archive in-process.
+    
+    Returns the paths written. If Python can't read the archive, anything 
+    written so far is removed and None is returned."""
+    
+    try:
+        writtenPaths, skipped = readers[archiveFormat(archivePath)](archivePath, 
+                                                               destDirectoryPath)
+    except (zipfile.BadZipfile, zipfile.LargeZipFile, tarfile.TarError, 
+            RuntimeError, NotImplementedError, EnvironmentError, EOFError), e:
+        log("Could not read %s: %s" % (quote(os.path.basename(archivePath)), e))
+        shutil.rmtree(destDirectoryPath, ignore_errors=True)
+        os.mkdir(destDirectoryPath)
+        return None
+    
+    log("Extracted %d files." % len(writtenPaths))
+    if skipped:
+        log("Skipped %d files which would not have been kept." % skipped)
+    return writtenPaths
@@ -23,14 +23,26 @@ This file provides functions to split audio in one of two ways: based on a CUE
 file or a wrapped audio file (AlbumWrap or MP3Wrap).
 If there is one or more cues in a directory split is called to attempt to match
 the cues to audio files and then to split them using the command-line 
-program mp3splt."""
+program mp3splt.
+
+A disc image in a format which has to be converted anyway (Monkey's Audio, 
+WavPack, Musepack or WAV) is instead handled by splitImage, before conversion:
+the image is decoded once and each track is encoded straight to its own Ogg 
+file, several tracks at a time. This saves converting the whole image to one 
+big Ogg file and then splitting that."""
 
 import os
+import re
+import wave
 import shutil
+import tempfile
 import subprocess
 from math import log10
 
 from etc import functions
+from etc import journal
+from etc import configuration as conf
+from filehandling import convert
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
@@ -41,7 +53,10 @@ def split(cuePaths, audioFilePaths):
     Takes a list of cue paths and a list of audio file paths.
     Rejects the folder if there are inequal numbers of audio and cue files.
     If there is one cue/audio pair, it is split using mp3splt. 
-    If there are multiple pairs, they are moved into their own folders."""
+    If there are multiple pairs, they are moved into their own folders.
+    
+    Returns a list of the files or folders created and a list of the paths 
+    removed (which is just the folder itself if it was rejected)."""
     
     numCues = len(cuePaths)
     directoryPath = os.path.dirname(cuePaths[0])
@@ -50,7 +65,7 @@ def split(cuePaths, audioFilePaths):
         log("There are unequal numbers of cues and audio files in %s." % 
             quote(directoryPath))
         functions.rejectItem(directoryPath)
-        return
+        return [], [directoryPath]
 
     if numCues == 1:
         cuePath = cuePaths[0]
@@ -60,7 +75,11 @@ def split(cuePaths, audioFilePaths):
             (quote(os.path.basename(audioFilePath)), 
              quote(os.path.basename(cuePath))))
         
-        command = ['mp3splt', '-d', directoryPath, '-c', cuePath, audioFilePath]
+        # The tracks are written to a folder of their own first, so that we 
+        # know which files are new without listing the whole directory again.
+        outputDirectoryPath = tempfile.mkdtemp(prefix=".split-", dir=directoryPath)
+        command = ['mp3splt', '-d', outputDirectoryPath, '-c', cuePath, 
+                   audioFilePath]
         log(" ".join(command))
         
         try:
@@ -71,8 +90,18 @@ def split(cuePaths, audioFilePaths):
             log("%s command not found." % command[0])
             success = False
 
+        createdPaths = []
+        for fileName in sorted(os.listdir(outputDirectoryPath)):
+            filePath = os.path.join(directoryPath, toUnicode(fileName))
+            if success and not os.path.exists(filePath):
+                shutil.move(os.path.join(outputDirectoryPath, fileName), filePath)
+                createdPaths.append(filePath)
+        shutil.rmtree(outputDirectoryPath, ignore_errors=True)
+
         if success:
             log("Successfully split %s." % quote(audioFilePath))
+            journal.record(directoryPath, "split", 
+                           inputs=[cuePath, audioFilePath])
             functions.deleteItem(cuePath)
             functions.deleteItem(audioFilePath)
 
@@ -80,11 +109,13 @@ def split(cuePaths, audioFilePaths):
             log("Unable to split %s." % quote(audioFilePath))
             functions.rejectItem(cuePath)
             functions.rejectItem(audioFilePath)
+            
+        return createdPaths, [cuePath, audioFilePath]
                            
     else: 
-        log("Multiple cue/audio pairs in %s." % quote(directoryName))
+        log("Multiple cue/audio pairs in %s." % quote(directoryPath))
         pairs = [(audioFilePaths[i], cuePaths[i]) for i in range(numCues)]
-        functions.moveDiscsIntoFolders(pairs)
+        return functions.moveDiscsIntoFolders(pairs), audioFilePaths + cuePaths
 
 def unwrap(audioFilePaths):
     """Attempt to split possible AlbumWrap or MP3Wrap audio files.
@@ -96,5 +127,215 @@ def unwrap(audioFilePaths):
     TODO: Implement this."""
     
     pass
+
+# Commands which decode a disc image to the WAV file $t. WAV images are read as
+# they are.
+imageDecoders = {".ape": ['mac', '$$.ape', '$t', '-d'],
+                 ".wv" : ['wvunpack', '-y', '$$.wv', '-o', '$t'],
+                 ".mpc": ['mpcdec', '$$.mpc', '$t'],
+                 ".wav": None}
+
+CD_FRAMES_PER_SECOND = 75
+
+vorbisNames = {"release": "album"}
+
+def parseCue(cuePath):
+    """Read a cue sheet; return (release metadata, list of track metadata).
+    
+    Each track's metadata includes "start", the position of its INDEX 01 in 
+    CD frames (1/75 of a second). Returns None if the cue can't be read or
+    refers to more than one audio file."""
+    
+    try:
+        with open(cuePath, "rb") as f:
+            lines = toUnicode(f.read()).splitlines()
+    except IOError:
+        return None
+    
+    release = {}
+    tracks = []
+    numFiles = 0
+    for line in lines:
+        match = re.match(r"^\s*(?:REM\s+)?(\w+)\s+(.*?)\s*$", line)
+        if not match:
+            continue
+        keyword, value = match.group(1).upper(), match.group(2)
+        if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        fields = tracks[-1] if tracks else release
+        
+        if keyword == "FILE":
+            numFiles += 1
+        elif keyword == "TRACK":
+            number = value.split()[0]
+            if not number.isdigit():
+                return None
+            tracks.append({"tracknumber": unicode(int(number))})
+        elif keyword == "TITLE":
+            fields["title" if tracks else "release"] = value
+        elif keyword == "PERFORMER":
+            fields["artist"] = value
+        elif keyword in ("DATE", "GENRE") and not tracks:
+            fields[keyword.lower()] = value
+        elif keyword == "INDEX" and tracks:
+            index = re.match(r"^0*1\s+(\d+):(\d+):(\d+)$", value)
+            if index:
+                minutes, seconds, frames = [int(n) for n in index.groups()]
+                tracks[-1]["start"] = ((minutes * 60 + seconds) * 
+                                       CD_FRAMES_PER_SECOND + frames)
+    
+    if numFiles != 1 or not tracks or any("start" not in track 
+                                          for track in tracks):
+        return None
+    return release, tracks
+
+@logfn("\nSplitting the disc image into tracks and converting them to Ogg.")
+def splitImage(cuePath, imagePath):
+    """Split a disc image on its cue, encoding each track straight to Ogg.
+    
+    The image is decoded once (unless it is a WAV already) and the tracks are
+    encoded on the convert pool, tagged with what the cue says. On success the
+    cue and image are removed and the Ogg files created and the paths removed
+    are returned. On failure everything created is removed and ([], []) is 
+    returned, leaving the image to be converted and then split as usual."""
+    
+    directoryPath = os.path.dirname(imagePath)
+    cue = parseCue(cuePath)
+    if not cue:
+        log("Could not read the tracks from %s." % quote(cuePath))
+        return [], []
+    release, tracks = cue
     
-    
\ No newline at end of file
+    numBytes = os.path.getsize(imagePath)
+    convert.stats.start()
+    workDirectoryPath = tempfile.mkdtemp(prefix=".split-", dir=directoryPath)
+    outputPaths = []
+    success = False
+    try:
+        wavPath = decodeImage(imagePath, workDirectoryPath)
+        if wavPath:
+            jobs = []
+            plan = planTracks(directoryPath, release, tracks)
+            for start, end, outputPath, metadata in plan:
+                if os.path.exists(outputPath) or outputPath in outputPaths:
+                    log("%s already exists." % quote(outputPath))
+                    break
+                outputPaths.append(outputPath)
+                jobs.append(convert.getConvertPool().submit(encodeTrack, 
+                            wavPath, start, end, outputPath, metadata))
+            results = [job.result() for job in jobs]
+            success = len(results) == len(plan) and all(results)
+    finally:
+        shutil.rmtree(workDirectoryPath, ignore_errors=True)
+        convert.stats.stop(numBytes, success)
+        
+    if not success:
+        log("Unable to split %s in one pass." % quote(imagePath))
+        for outputPath in outputPaths:
+            if os.path.exists(outputPath):
+                os.remove(outputPath)
+        return [], []
+    
+    log("Successfully split %s." % quote(imagePath))
+    journal.record(directoryPath, "split", inputs=[cuePath, imagePath])
+    functions.deleteItem(cuePath)
+    functions.deleteItem(imagePath)
+    return outputPaths, [cuePath, imagePath]
+
+def planTracks(directoryPath, release, tracks):
+    """Return (start, end, output path, tags) for each track read from a cue.
+    
+    Takes what parseCue returns. A track ends where the next one starts; the
+    last one's end is None (the end of the image)."""
+    
+    plan = []
+    for i, track in enumerate(tracks):
+        end = tracks[i + 1]["start"] if i + 1 < len(tracks) else None
+        metadata = dict(release, **track)
+        del metadata["start"]
+        metadata["tracktotal"] = unicode(len(tracks))
+        outputPath = os.path.join(directoryPath, u"%s - %s.ogg" % (
+            track["tracknumber"].rjust(2, u"0"), 
+            translateForFilename(track.get("title", u"Track"))))
+        plan.append((track["start"], end, outputPath, metadata))
+    return plan
+
+def decodeImage(imagePath, workDirectoryPath):
+    """Return the path of the image decoded to WAV, or None on failure."""
+    
+    filePathWithoutExtension, extension = os.path.splitext(imagePath)
+    command = imageDecoders[extension.lower()]
+    if not command:
+        return imagePath
+    
+    wavPath = os.path.join(workDirectoryPath, "image.wav")
+    cmd = [arg.replace("$$", filePathWithoutExtension).replace("$t", wavPath)
+           for arg in command]
+    log(" ".join(cmd))
+    try:
+        p = subprocess.Popen(cmd, close_fds=True)
+        p.wait()
+    except OSError:
+        log("%s command not found." % cmd[0])
+        return None
+    return wavPath if p.returncode == 0 else None
+
+def encodeTrack(wavPath, start, end, outputPath, metadata):
+    """Encode part of a WAV file to a tagged Ogg file; return True on success.
+    
+    start and end are positions in CD frames; an end of None means the end of
+    the file. The audio is piped into oggenc as raw samples."""
+    
+    with logSection("Encoding %s." % quote(os.path.basename(outputPath))):
+        try:
+            reader = wave.open(wavPath, "rb")
+        except (wave.Error, EOFError, IOError), e:
+            log("Could not read the decoded audio: %s" % e)
+            return False
+        
+        try:
+            channels = reader.getnchannels()
+            sampleWidth = reader.getsampwidth()
+            rate = reader.getframerate()
+            startSample = start * rate // CD_FRAMES_PER_SECOND
+            if end is None:
+                endSample = reader.getnframes()
+            else:
+                endSample = min(end * rate // CD_FRAMES_PER_SECOND, 
+                                reader.getnframes())
+            reader.setpos(startSample)
+            
+            cmd = ['oggenc', '-q', str(conf.ENCODING_QUALITY["HIGH"]), '-r', 
+                   '-B', str(sampleWidth * 8), '-C', str(channels), 
+                   '-R', str(rate), '-o', outputPath]
+            for field, value in sorted(metadata.items()):
+                # Vorbis comments call the release the album (see tagging).
+                comment = u"%s=%s" % (vorbisNames.get(field, field).upper(), value)
+                cmd.extend(['-c', comment.encode("utf-8")])
+            cmd.append('-')
+            log(" ".join(cmd[:cmd.index('-o') + 2]))
+            
+            # This runs on the convert pool beside convert.stream, so (as 
+            # there) close_fds keeps oggenc from holding open other pipes.
+            try:
+                p = subprocess.Popen(cmd, stdin=subprocess.PIPE, close_fds=True)
+            except OSError:
+                log("oggenc command not found.")
+                return False
+            
+            remaining = endSample - startSample
+            try:
+                while remaining > 0:
+                    samples = reader.readframes(min(remaining, 65536))
+                    if not samples:
+                        break
+                    p.stdin.write(samples)
+                    remaining -= len(samples) // (sampleWidth * channels)
+            except IOError:
+                pass                    # oggenc quit; its return code says why
+            finally:
+                p.stdin.close()
+            p.wait()
+            return p.returncode == 0
+        finally:
+            reader.close()
@@ -23,12 +23,39 @@ Handling begins when the GUI invokes handleIt with a list of directories to act
 upon. This function calls traverse upon each. After determining what types of
 files are present, traverse calls the proper functions to handle each type.
 When this process ends - either after being stopped by the user, encountering
-an error, or reaching completion - handleIt emits a signal to inform the GUI."""
+an error, or reaching completion - handleIt emits a signal to inform the GUI.
+
+If configuration.SETTINGS["DIRECTORY_WORKERS"] is more than one, traverse 
+hands the directories to a pool of that many threads instead of handling them
+one after another. A directory is still only handled once all of its 
+subdirectories have been, but directories which do not contain one another 
+are handled at the same time, so one release can be converted or tagged while
+another waits on MusicBrainz.
+
+If configuration.SETTINGS["PIPELINE"] is set, directories are instead sent 
+through a pipeline (see etc.pipeline) whose stages are the steps of 
+handleDirectory: preparing, converting, splitting, fingerprinting, 
+identifying, tagging and moving. Each stage has its own number of threads
+(configuration.SETTINGS["STAGE_WORKERS"]), so the files of the next directory
+are being converted while this one waits on MusicBrainz.
+
+If configuration.SETTINGS["INCREMENTAL"] is set, directories which have not
+changed since they were last handled are skipped (see etc.manifest).
+
+How far each directory has got is recorded in a journal, so that a run which
+is stopped or crashes can be resumed where it left off (see etc.journal).
+
+If configuration.SETTINGS["ORGANIZE"] is set, the folders to scan are left as
+they are and a linked copy of each is traversed instead (see organize)."""
 
 import os
 import sys
 import time
+import Queue
+import shutil
+import hashlib
 import traceback
+import threading
 
 try:
     from PyQt4.QtCore import SIGNAL
@@ -40,6 +67,11 @@ from etc import configuration
 from etc import functions
 from etc import flowcontrol
 from etc import cache
+from etc import manifest
+from etc import journal
+from etc import transfer
+from etc.workers import WorkerPool
+from etc.pipeline import Pipeline
 
 from filehandling import extract
 from filehandling import clean
@@ -47,20 +79,38 @@ from filehandling import convert
 from filehandling import split
 
 from metadata import metadata
+from metadata import Manager
 
 from etc.utils import *
 from etc.flowcontrol import emitter
 from etc.logger import log, logfn, logSection
 
+directoryPool = None
+directoryPoolLock = threading.Lock()
+
+def getDirectoryPool():
+    """Return the pool which handles directories, creating it if necessary."""
+    
+    global directoryPool
+    with directoryPoolLock:
+        if not directoryPool:
+            directoryPool = WorkerPool(configuration.SETTINGS["DIRECTORY_WORKERS"])
+    return directoryPool
+
 def handleIt():
     """Call traverse on directories; when run ends for any reason, inform GUI."""
     
     cache.loadCacheDB()
+    journal.load()
+    convert.stats.reset()
     try:
         for directoryPath in configuration.PATHS["TO_SCAN"]:
             with logSection("Traversing %s." % quote(directoryPath)):
                 configuration.PATHS["CURRENT"] = directoryPath
-                traverse(directoryPath)
+                if configuration.SETTINGS["ORGANIZE"]:
+                    organize(directoryPath, directoryPath)
+                else:
+                    traverse(directoryPath)
     except flowcontrol.StopException:
         if gui: emitter.emit(SIGNAL("RunEnded"), "stopped")
     except:
@@ -68,30 +118,345 @@ def handleIt():
         if gui: emitter.emit(SIGNAL("RunEnded"), "failed")
     else:
         if gui: emitter.emit(SIGNAL("RunEnded"), "complete")
+    logSummary()
     cache.saveCacheDB()
 
-def traverse(directoryPath):
-    """Recursively traverse directories."""
+def logSummary():
+    """Log a summary of the work done during the run."""
     
-    flowcontrol.checkpoint(cleanStopPoint=True)
-    if not functions.validatePath(directoryPath, isDirectory=True):
+    if convert.stats.numFiles or convert.stats.numFailed:
+        with logSection("\nSummary."):
+            log(str(convert.stats))
+
+def organize(rootPath, directoryPath, recurse=True):
+    """Traverse a linked copy of directoryPath, leaving the original untouched.
+    
+    rootPath is the TO_SCAN directory which directoryPath is (or is in). Its
+    tree is linked (see etc.transfer.linkTree) into a working folder in 
+    .audiolog-organize in SORTED and that is traversed instead, so everything 
+    Audiolog does (renaming, converting, extracting, tagging, moving into 
+    SORTED) happens to the links. Audio is only copied, as a reflink if 
+    possible, when its tags are written. Afterwards whatever was not moved 
+    out of the working folder is deleted, except for its rejects and deletes.
+    
+    If recurse is False, only the files directly in directoryPath are linked 
+    and handled (see traverseFiles).
+    
+    Since the originals stay where they are, every run would find them all 
+    again. If configuration.SETTINGS["INCREMENTAL"] is set, the directories
+    under directoryPath are recorded in the manifest once they have been 
+    organized, and those which have not changed since are not linked again."""
+    
+    sortedPath = configuration.PATHS["SORTED"]
+    workRootPath = os.path.join(sortedPath, ".audiolog-organize", 
+                                workFolderName(rootPath))
+    workPath = os.path.normpath(os.path.join(workRootPath, 
+                                os.path.relpath(directoryPath, rootPath)))
+    
+    def skipDirectory(path):
+        return (not recurse or "Audiolog_" in os.path.basename(path) or 
+                os.path.abspath(path) == os.path.abspath(sortedPath))
+    
+    signatures = {}
+    if configuration.SETTINGS["INCREMENTAL"] and recurse:
+        signatures = manifest.treeSignatures(directoryPath, skipDirectory)
+    
+    def isUnchanged(path):
+        path = toUnicode(path)
+        if path in signatures and manifest.isUnchanged(path, signatures[path]):
+            log("Skipping %s; it has not changed since it was last handled." 
+                % quote(path))
+            return True
+        return False
+    
+    if isUnchanged(directoryPath):
         return
     
-    subdirectoryPaths = functions.getValidSubdirectories(directoryPath)
+    log("Linking %s into %s." % (quote(directoryPath), quote(workPath)))
+    transfer.linkTree(directoryPath, workPath, 
+                      lambda path: skipDirectory(path) or isUnchanged(path))
+    configuration.PATHS["CURRENT"] = workRootPath
+    try:
+        if recurse:
+            traverse(workPath)
+        else:
+            traverseFiles(workPath)
+        for path, signature in signatures.items():
+            manifest.record(path, "handled", signature)
+    finally:
+        configuration.PATHS["CURRENT"] = rootPath
+        if not os.path.isdir(workPath):
+            leftoverPaths = []
+        elif workPath == workRootPath:
+            leftoverPaths = [os.path.join(workPath, name) 
+                             for name in os.listdir(workPath)
+                             if not name.startswith("Audiolog_")]
+        else:
+            leftoverPaths = [workPath]
+        for leftoverPath in leftoverPaths:
+            if os.path.isdir(leftoverPath):
+                shutil.rmtree(leftoverPath, ignore_errors=True)
+            elif os.path.lexists(leftoverPath):
+                os.remove(leftoverPath)
+
+def workFolderName(rootPath):
+    """Return the name of the folder a TO_SCAN directory is organized in.
+    
+    The name includes a hash of the full path, so that TO_SCAN directories 
+    with the same name do not share a folder."""
+    
+    rootPath = os.path.abspath(rootPath.rstrip(os.sep))
+    pathHash = hashlib.sha1(toUnicode(rootPath).encode("utf-8")).hexdigest()
+    return "%s-%s" % (os.path.basename(rootPath), pathHash[:8])
+
+def traverse(directoryPath, inventory=None):
+    """Recursively traverse directories.
+    
+    inventory is the Inventory of the directory if the caller already has 
+    one; otherwise the directory is listed here."""
+    
+    if ((configuration.SETTINGS["PIPELINE"] 
+         or configuration.SETTINGS["DIRECTORY_WORKERS"] > 1
+         or configuration.SETTINGS["INCREMENTAL"])
+        and not getDirectoryPool().inWorker()):
+        return traverseConcurrently(directoryPath)
+    
+    flowcontrol.checkpoint(cleanStopPoint=True)
+    inventory = inventory or functions.getInventory(directoryPath)
+    if not inventory:
+        return
     
     # If appropriate, rename and recurse into subdirectories
-    if subdirectoryPaths:
-        for subdirectoryPath in clean.standardizeFilenames(subdirectoryPaths):
-            traverse(subdirectoryPath)
+    traverseSubdirectories(inventory.subdirectoryPaths)
 
     # We are now in a leaf directory with no subdirectories.
     with logSection("\nHandling %s." % quote(directoryPath)):
-        handleDirectory(directoryPath)
+        handleDirectory(directoryPath, inventory)
+
+def traverseFiles(directoryPath):
+    """Handle the files directly in a directory, leaving its subdirectories be.
+    
+    This is for when only the directory's own files have changed (see watch);
+    subdirectories created while handling them are still traversed."""
+    
+    flowcontrol.checkpoint(cleanStopPoint=True)
+    inventory = functions.getInventory(directoryPath)
+    if not inventory:
+        return
+    
+    with logSection("\nHandling the files in %s." % quote(directoryPath)):
+        handleDirectory(directoryPath, inventory)
+
+def traverseSubdirectories(subdirectoryPaths):
+    """Standardize the names of the subdirectories, then traverse each.
+    
+    The tags of the next subdirectory are read ahead while one is traversed; 
+    its Inventory is then handed on to traverse rather than listing it again."""
+    
+    if subdirectoryPaths:
+        subdirectoryPaths = clean.standardizeFilenames(subdirectoryPaths)
+        nextInventory = None
+        for i, subdirectoryPath in enumerate(subdirectoryPaths):
+            inventory, nextInventory = nextInventory, None
+            if configuration.ACTIONS["METADATA"] and i + 1 < len(subdirectoryPaths):
+                nextInventory = functions.getInventory(subdirectoryPaths[i + 1])
+                if nextInventory:
+                    metadata.readAhead(nextInventory)
+            traverse(subdirectoryPath, inventory)
+
+def traverseConcurrently(rootPath):
+    """Traverse directories, handling independent ones at the same time.
+    
+    The tree is walked first (standardizing the names of subdirectories as
+    traverse does). Directories without subdirectories are started straight
+    away, and every other directory is started once the last of its 
+    subdirectories has been handled. Directories are handled on the directory
+    pool or, if configuration.SETTINGS["PIPELINE"] is set, sent through the 
+    pipeline. Each directory's log messages are written together when it 
+    finishes. If handling a directory fails, no more directories are started 
+    and the exception is raised once the ones already running have finished."""
+    
+    parents = {}
+    numChildren = {}
+    inventories = {}
+    
+    incremental = configuration.SETTINGS["INCREMENTAL"]
+    
+    def walk(directoryPath, leaves):
+        """Register the directory and its subtree; return its signature.
+        
+        Returns None if the directory is not valid. If the directory is 
+        unchanged since it was last handled, it is not registered at all."""
+        
+        flowcontrol.checkpoint(cleanStopPoint=True)
+        inventory = functions.getInventory(directoryPath)
+        if not inventory:
+            return None
+        subdirectoryPaths = inventory.subdirectoryPaths
+        if subdirectoryPaths:
+            subdirectoryPaths = clean.standardizeFilenames(subdirectoryPaths)
+            
+        subdirectorySignatures = []
+        children = []
+        for subdirectoryPath in subdirectoryPaths:
+            signature = walk(subdirectoryPath, leaves)
+            if signature:
+                subdirectorySignatures.append(
+                    (toUnicode(os.path.basename(subdirectoryPath)), signature))
+                if subdirectoryPath in inventories:
+                    children.append(subdirectoryPath)
+        
+        signature = True
+        if incremental:
+            signature = manifest.directorySignature(inventory, 
+                                                    subdirectorySignatures)
+            if not children and manifest.isUnchanged(directoryPath, signature):
+                log("Skipping %s; it has not changed since it was last handled." 
+                    % quote(directoryPath))
+                return signature
+            
+        inventories[directoryPath] = inventory
+        for subdirectoryPath in children:
+            parents[subdirectoryPath] = directoryPath
+        numChildren[directoryPath] = len(children)
+        if not children:
+            leaves.append(directoryPath)
+        return signature
+    
+    leaves = []
+    if not walk(rootPath, leaves):
+        return
+    
+    finishedJobs = Queue.Queue()
+    running = {}
+    waitingItems = {}
+    error = None
+    
+    def start(directoryPath):
+        description = "\nHandling %s." % quote(directoryPath)
+        if directoryPath in waitingItems:
+            item = waitingItems.pop(directoryPath)
+            job = getPipeline().submit(item, description, item.resumeStage)
+        elif configuration.SETTINGS["PIPELINE"]:
+            inventory = inventories.pop(directoryPath)
+            job = getPipeline().submit(DirectoryItem(directoryPath, inventory),
+                                       description)
+        else:
+            inventory = inventories.pop(directoryPath)
+            job = getDirectoryPool().submit(handleSubtree, directoryPath, 
+                                            inventory)
+        running[job] = directoryPath
+        job.addCallback(finishedJobs.put)
+    
+    for directoryPath in leaves:
+        start(directoryPath)
+        
+    while running:
+        job = finishedJobs.get()
+        directoryPath = running.pop(job)
+        try:
+            item = job.result()
+            if item and item.newSubdirectoryPaths:
+                # Extracting or splitting added subdirectories. They are handled
+                # first, then the directory goes back into the pipeline.
+                subdirectoryPaths = clean.standardizeFilenames(
+                                        item.newSubdirectoryPaths)
+                item.newSubdirectoryPaths = None
+                waitingItems[directoryPath] = item
+                leaves = []
+                subdirectoryPaths = [path for path in subdirectoryPaths 
+                                     if walk(path, leaves) 
+                                     and path in inventories]
+                for subdirectoryPath in subdirectoryPaths:
+                    parents[subdirectoryPath] = directoryPath
+                numChildren[directoryPath] = len(subdirectoryPaths)
+                if not error:
+                    for leafPath in leaves or [directoryPath]:
+                        start(leafPath)
+                continue
+        except flowcontrol.StopException:
+            # Start nothing more, but leave the directories being handled to 
+            # stop at their own checkpoints or, if stopping cleanly, to finish.
+            if not error:
+                error = sys.exc_info()
+            continue
+        except:
+            if incremental:
+                manifest.record(directoryPath, "failed")
+            if not error:
+                error = sys.exc_info()
+                for otherJob in running:
+                    otherJob.cancel()
+            continue
+        # A cancelled job may have stopped before the directory was (fully) 
+        # handled, so it is not recorded and the directory is handled next time.
+        if incremental and not job.cancelled:
+            manifest.record(directoryPath, "handled")
+        if error:
+            continue
+        
+        parentPath = parents.get(directoryPath)
+        if parentPath:
+            numChildren[parentPath] -= 1
+            if not numChildren[parentPath]:
+                start(parentPath)
+    
+    if error:
+        raise error[0], error[1], error[2]
+
+def handleSubtree(directoryPath, inventory):
+    """Handle a directory whose subdirectories have all been handled already.
+    
+    Runs on the directory pool. If handling the directory produces new 
+    subdirectories (by extracting archives), they are traversed here."""
+    
+    flowcontrol.checkpoint(cleanStopPoint=True)
+    with logSection("\nHandling %s." % quote(directoryPath)):
+        handleDirectory(directoryPath, inventory)
 
-def handleDirectory(directoryPath):
-    """Take actions based on file types present and the user's configuration."""
+def handleDirectory(directoryPath, inventory=None):
+    """Take actions based on file types present and the user's configuration.
+    
+    inventory is the Inventory of the directory if the caller already has 
+    one; otherwise the directory is listed here. Each step updates it with 
+    the files it created and removed, so the directory is never listed again."""
+    
+    inventory = inventory or functions.getInventory(directoryPath)
+    if not inventory:
+        return
+    
+    removeFinishedInputs(inventory)
+    traverseSubdirectories(prepareDirectory(inventory))                         # Traverse any new subdirectories
+    convertAudio(inventory)
+    traverseSubdirectories(splitAudio(inventory))
+    audioPaths = findAudio(inventory)
+        
+    if audioPaths and configuration.ACTIONS["METADATA"]:                        # Handle metadata
+        audioPaths = clean.standardizeFilenames(audioPaths)
+        metadata.handleMetadata(directoryPath, audioPaths)
+    journal.finish(directoryPath)
+
+def removeFinishedInputs(inventory):
+    """Remove files an interrupted run had finished with but not yet removed.
+    
+    These are archives that were extracted, audio that was converted or split
+    and so on, according to the journal. Removing them keeps the steps from 
+    being repeated. Files which have changed since they were recorded are 
+    kept (see journal.finishedInputs)."""
+    
+    inputPaths = journal.finishedInputs(inventory.directoryPath)
+    if inputPaths:
+        log("\nRemoving files left over from an interrupted run.")
+        functions.deleteItems(inputPaths)
+        inventory.update([], inputPaths)
+
+def prepareDirectory(inventory):
+    """Handle images, delete extra files and extract archives.
+    
+    Returns the paths of the subdirectories the archives were extracted into,
+    which must be traversed before the directory itself is handled further."""
     
-    filePathsByType = functions.getFilePathsByType(directoryPath)
+    filePathsByType = inventory.filePathsByType
     
     if configuration.ACTIONS["IMAGE"] and "image" in filePathsByType:           # Rename/delete image(s)
         clean.handleImages(filePathsByType["image"])
@@ -100,12 +465,52 @@ def handleDirectory(directoryPath):
         clean.cleanDir(filePathsByType["other"])
     
     if configuration.ACTIONS["EXTRACT"] and "archive" in filePathsByType:       # Extract archives
-        extract.extract(filePathsByType["archive"])                             # There may be new subdirectories
-        return traverse(directoryPath)                                          # Traverse again
+        return inventory.update(*extract.extract(filePathsByType["archive"]))
+    
+    return []
+
+def convertAudio(inventory):
+    """Convert any audio in an undesirable format to Ogg.
+    
+    If the audio is a single disc image with a cue, it is split and converted
+    in one go (see split.splitImage), falling back to converting it here and
+    splitting it afterwards."""
+    
+    filePathsByType = inventory.filePathsByType
+    
+    if (configuration.ACTIONS["CONVERT"] and configuration.ACTIONS["SPLIT"]
+        and len(filePathsByType.get("cue", [])) == 1
+        and len(filePathsByType.get("bad_audio", [])) == 1
+        and "good_audio" not in filePathsByType
+        and ext(filePathsByType["bad_audio"][0]) in split.imageDecoders):
+        inventory.update(*split.splitImage(filePathsByType["cue"][0], 
+                                           filePathsByType["bad_audio"][0]))
+    
+    if configuration.ACTIONS["CONVERT"] and "bad_audio" in filePathsByType:
+        inventory.update(*convert.convert(filePathsByType["bad_audio"]))
         
-    if configuration.ACTIONS["CONVERT"] and "bad_audio" in filePathsByType:     # Convert audio to Ogg and scan again
-        convert.convert(filePathsByType["bad_audio"])
-        return handleDirectory(directoryPath)
+def splitAudio(inventory):
+    """Split audio based on cues.
+    
+    Returns the paths of any subdirectories created (when there are several
+    cue/audio pairs, each is moved into a folder of its own)."""
+    
+    filePathsByType = inventory.filePathsByType
+            
+    if ("good_audio" in filePathsByType and configuration.ACTIONS["SPLIT"] 
+        and "cue" in filePathsByType):                                          # Split based on cue
+        return inventory.update(*split.split(filePathsByType["cue"], 
+                                             filePathsByType["good_audio"]))
+    
+    return []
+
+def findAudio(inventory):
+    """Return the paths of the directory's audio.
+    
+    If there is no audio, the directory is removed and None is returned."""
+    
+    directoryPath = inventory.directoryPath
+    filePathsByType = inventory.filePathsByType
         
     if not "good_audio" in filePathsByType:                                     # Continue if audio present
         log("\nNo audio found in %s." % quote(directoryPath))
@@ -113,13 +518,119 @@ def handleDirectory(directoryPath):
         # directory actually be accepted rather than deleted at this point?
         if directoryPath != configuration.PATHS["CURRENT"]:
             functions.deleteItem(directoryPath)
-        return
-            
-    if configuration.ACTIONS["SPLIT"] and "cue" in filePathsByType:             # Split based on cue and scan again
-        split.split(filePathsByType["cue"], filePathsByType["good_audio"])
-        return handleDirectory(directoryPath)
+        return None
+    
+    return filePathsByType["good_audio"]
+
+
+#-------------------------------------------
+# Pipeline
+#-------------------------------------------
+
+class DirectoryItem(object):
+    """A directory on its way through the pipeline.
+    
+    If a stage creates subdirectories, it sets newSubdirectoryPaths and 
+    resumeStage and the directory leaves the pipeline. traverseConcurrently
+    handles the subdirectories and then sends the directory back in at 
+    resumeStage."""
+    
+    def __init__(self, directoryPath, inventory):
+        self.directoryPath = directoryPath
+        self.inventory = inventory
+        self.newSubdirectoryPaths = None
+        self.resumeStage = None
+        self.releaseManager = None
+        self.error = None
         
-    if configuration.ACTIONS["METADATA"]:                                       # Handle metadata
-        audioPaths = clean.standardizeFilenames(filePathsByType["good_audio"])
-        metadata.handleMetadata(directoryPath, audioPaths)
-    
\ No newline at end of file
+    def leaveFor(self, subdirectoryPaths, resumeStage):
+        """Leave the pipeline until the new subdirectories are handled."""
+        
+        self.newSubdirectoryPaths = subdirectoryPaths
+        self.resumeStage = resumeStage
+        return None
+
+def prepareStage(item):
+    """Handle images, extra files and archives."""
+    
+    flowcontrol.checkpoint(cleanStopPoint=True)
+    removeFinishedInputs(item.inventory)
+    newSubdirectoryPaths = prepareDirectory(item.inventory)
+    if newSubdirectoryPaths:
+        return item.leaveFor(newSubdirectoryPaths, "convert")
+    return "convert"
+
+def convertStage(item):
+    """Convert audio in undesirable formats."""
+    
+    convertAudio(item.inventory)
+    return "split"
+
+def splitStage(item):
+    """Split audio on cues; start reading the tags of the release."""
+    
+    newSubdirectoryPaths = splitAudio(item.inventory)
+    if newSubdirectoryPaths:
+        return item.leaveFor(newSubdirectoryPaths, "split")
+    audioPaths = findAudio(item.inventory)
+    if not audioPaths or not configuration.ACTIONS["METADATA"]:
+        journal.finish(item.directoryPath)
+        return None
+    audioPaths = clean.standardizeFilenames(audioPaths)
+    item.releaseManager = metadata.createReleaseManager(item.directoryPath, 
+                                                        audioPaths)
+    return "fingerprint"
+
+def fingerprintStage(item):
+    """Fingerprint the audio and look it up in MusicDNS."""
+    
+    item.releaseManager.fingerprint()
+    return "identify"
+
+def identifyStage(item):
+    """Gather the metadata; skip tagging if the release can't be identified."""
+    
+    try:
+        item.releaseManager.identify()
+    except Manager.ReleaseManagerError, e:
+        item.error = e
+        return "move"
+    return "tag"
+
+def tagStage(item):
+    """Write the tags and filenames."""
+    
+    item.releaseManager.writeResults()
+    return "move"
+
+def moveStage(item):
+    """Accept or reject the directory."""
+    
+    metadata.fileRelease(item.directoryPath, item.releaseManager, item.error)
+    journal.finish(item.directoryPath)
+    return None
+
+# The order in which directories pass through the stages of the pipeline. The 
+# first four mostly keep the CPU and disks busy; the rest mostly wait on the
+# network or on moving files.
+stages = [("prepare",     prepareStage),
+          ("convert",     convertStage),
+          ("split",       splitStage),
+          ("fingerprint", fingerprintStage),
+          ("identify",    identifyStage),
+          ("tag",         tagStage),
+          ("move",        moveStage)]
+
+directoryPipeline = None
+
+def getPipeline():
+    """Return the pipeline which handles directories, creating it if necessary."""
+    
+    global directoryPipeline
+    with directoryPoolLock:
+        if not directoryPipeline:
+            stageWorkers = configuration.SETTINGS["STAGE_WORKERS"]
+            directoryPipeline = Pipeline([(name, fn, stageWorkers.get(name, 1)) 
+                                          for name, fn in stages],
+                                         configuration.SETTINGS["STAGE_QUEUE_SIZE"])
+    return directoryPipeline
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+#  Audiolog Music Organizer
+#  Copyright © 2011  Matt Hubert <matt@cfxnetworks.com>
+#                    Robert Nagle <rjn945@gmail.com>
+#
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Watch the TO_SCAN directories and handle new arrivals as they settle.
+
+watch runs until it is stopped. It notices changes under the directories in 
+configuration.PATHS["TO_SCAN"] with inotify (through pyinotify) if it is 
+installed, or else by looking over the directories every 
+configuration.SETTINGS["WATCH_POLL_SECONDS"]. A change is attributed to the
+top-level directory it happened in (the folder a download was dropped as).
+Once that directory has gone configuration.SETTINGS["WATCH_SETTLE_SECONDS"]
+without a change it is traversed as handleIt would traverse it. Files dropped
+directly into a TO_SCAN directory are handled on their own, without 
+traversing the rest of it.
+
+Because the program keeps running, the cache database, the worker threads
+and the connections to MusicBrainz stay warm between arrivals."""
+
+import os
+import time
+import traceback
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from etc import configuration
+from etc import flowcontrol
+from etc import cache
+from etc import journal
+
+from filehandling import traverse
+
+from etc.utils import *
+from etc.logger import log, logfn, logSection
+
+def watch():
+    """Handle directories under TO_SCAN as they settle, until stopped."""
+    
+    cache.loadCacheDB()
+    journal.load()
+    rootPaths = configuration.PATHS["TO_SCAN"]
+    if pyinotify:
+        watcher = InotifyWatcher(rootPaths)
+    else:
+        watcher = PollingWatcher(rootPaths)
+    log("Watching %s for new arrivals." % ", ".join(quote(path) for path in rootPaths))
+    
+    lastChanged = {}
+    try:
+        while True:
+            flowcontrol.checkpoint(cleanStopPoint=True)
+            for path in watcher.changedPaths(1):
+                arrival = findArrival(path)
+                if arrival:
+                    lastChanged[arrival] = time.time()
+            
+            settleTime = configuration.SETTINGS["WATCH_SETTLE_SECONDS"]
+            settled = sorted(arrival for arrival, changeTime in lastChanged.items() 
+                             if time.time() - changeTime >= settleTime)
+            for arrival in settled:
+                del lastChanged[arrival]
+                handleArrival(*arrival)
+            
+            # Ignore the changes we just made while handling the arrivals.
+            if settled:
+                for path in watcher.changedPaths(0):
+                    arrival = findArrival(path)
+                    if arrival and arrival not in settled:
+                        lastChanged[arrival] = time.time()
+    except (flowcontrol.StopException, KeyboardInterrupt):
+        log("\nNo longer watching for new arrivals.")
+    finally:
+        cache.saveCacheDB()
+
+def findArrival(path):
+    """Return (TO_SCAN directory, directory to traverse) for a changed path.
+    
+    A file directly in a TO_SCAN directory gives (TO_SCAN directory, TO_SCAN
+    directory), meaning only the files there are handled. Returns None for 
+    changes in Audiolog's own folders and for items removed from a TO_SCAN 
+    directory."""
+    
+    for rootPath in configuration.PATHS["TO_SCAN"]:
+        rootPath = rootPath.rstrip(os.sep)
+        if not path.startswith(rootPath + os.sep):
+            continue
+        topName = path[len(rootPath) + 1:].split(os.sep)[0]
+        if topName.startswith("Audiolog_"):
+            return None
+        topPath = os.path.join(rootPath, topName)
+        if topPath == path and not os.path.isdir(path):
+            if not os.path.isfile(path):
+                return None
+            return (rootPath, rootPath)             # A file directly in TO_SCAN
+        return (rootPath, topPath)
+    return None
+
+def handleArrival(rootPath, directoryPath):
+    """Traverse a directory which has stopped changing.
+    
+    If the directory is the TO_SCAN directory itself, only the files directly
+    in it are handled."""
+    
+    if not os.path.isdir(directoryPath):
+        return
+    
+    recurse = directoryPath != rootPath
+    with logSection("\nHandling new arrivals in %s." % quote(directoryPath)):
+        configuration.PATHS["CURRENT"] = rootPath
+        try:
+            if configuration.SETTINGS["ORGANIZE"]:
+                traverse.organize(rootPath, directoryPath, recurse)
+            elif recurse:
+                traverse.traverse(directoryPath)
+            else:
+                traverse.traverseFiles(directoryPath)
+        except flowcontrol.StopException:
+            raise
+        except:
+            traceback.print_exc()
+    cache.saveCacheDB()
+
+
+class InotifyWatcher(object):
+    """Collects the paths of changes reported by inotify."""
+    
+    if pyinotify:
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | 
+                pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO)
+    
+    def __init__(self, rootPaths):
+        self.changed = []
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.changed.append)
+        for rootPath in rootPaths:
+            self.manager.add_watch(rootPath, self.mask, rec=True, auto_add=True)
+            
+    def changedPaths(self, timeout):
+        """Wait up to timeout seconds for changes; return the changed paths."""
+        
+        while self.notifier.check_events(timeout * 1000):
+            self.notifier.read_events()
+            self.notifier.process_events()
+            timeout = 0
+        events = self.changed[:]
+        del self.changed[:]
+        return [toUnicode(event.pathname) for event in events]
+    
+
+class PollingWatcher(object):
+    """Finds changes by comparing the sizes and times of everything under the
+    TO_SCAN directories with what they were last time."""
+    
+    def __init__(self, rootPaths):
+        self.rootPaths = rootPaths
+        self.snapshot = self.takeSnapshot()
+        self.lastPoll = time.time()
+        
+    def takeSnapshot(self):
+        snapshot = {}
+        for rootPath in self.rootPaths:
+            for directoryPath, directoryNames, fileNames in os.walk(rootPath):
+                directoryNames[:] = [name for name in directoryNames 
+                                     if not name.startswith("Audiolog_")]
+                for name in directoryNames + fileNames:
+                    path = os.path.join(directoryPath, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_size, stat.st_mtime)
+        return snapshot
+    
+    def changedPaths(self, timeout):
+        """Wait up to timeout seconds; return the paths changed since last time.
+        
+        The directories are only looked over once every WATCH_POLL_SECONDS,
+        or straight away if timeout is 0."""
+        
+        if timeout:
+            time.sleep(timeout)
+            if (time.time() - self.lastPoll 
+                < configuration.SETTINGS["WATCH_POLL_SECONDS"]):
+                return []
+        
+        snapshot = self.takeSnapshot()
+        self.lastPoll = time.time()
+        changed = [path for path in set(snapshot) | set(self.snapshot)
+                   if snapshot.get(path) != self.snapshot.get(path)]
+        self.snapshot = snapshot
+        return [toUnicode(path) for path in changed]
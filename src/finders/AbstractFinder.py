@@ -34,16 +34,126 @@ AbstractFinder
             |---TitleFinder
             |---TrackNumberFinder"""
 
+import random
+import threading
+
 from metadata import tagging
 from metadata import musicbrainz as mb
 
 from etc import flowcontrol
+from etc import configuration
+from etc.workers import WorkerPool
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
+# Getters spend nearly all of their time waiting on the disk or on MusicBrainz, 
+# so the getter calls of a round are run on a pool of threads.
+getterPool = None
+getterPoolLock = threading.Lock()
+
+def uses(*fields, **options):
+    """Decorator declaring which known fields a getter's result depends on.
+    
+    These are the fields the getter reads from track.metadata, usually the 
+    relevantFields it passes to askMB ("tracks" meaning the track titles). 
+    Passing fuzzy=True marks a getter whose string is fuzzily matched by askMB,
+    which also uses whichever of the artist, release and title are known to 
+    choose between several matching substrings.
+    
+    ReleaseManager uses this to run a Finder again only once a field that 
+    could change one of its getters' results has become known."""
+    
+    def decorator(getter):
+        getter.usesFields = fields
+        getter.usesFuzzyMatch = options.get("fuzzy", False)
+        return getter
+    return decorator
+
+def getGetterPool():
+    """Return the pool shared by all Finders, creating it if necessary."""
+    
+    global getterPool
+    with getterPoolLock:
+        if not getterPool:
+            getterPool = WorkerPool(configuration.SETTINGS["GETTER_THREADS"])
+    return getterPool
+
 class AbstractFinder(object):
     """Base class for all Finders."""
 
+    def dependencies(self):
+        """Return the set of fields any of this Finder's getters depend on."""
+        
+        fields = set()
+        for (getter, weight) in self.getters:
+            fields.update(getattr(getter, "usesFields", ()))
+            if getattr(getter, "usesFuzzyMatch", False):
+                fields.update(["artist", "release", "title"])
+        fields.discard(self.fieldName)
+        return fields
+
+    def callGetter(self, getter, weight, track):
+        """Call one getter for one track; return a row of data for findConsensus."""
+        
+        flowcontrol.checkpoint()
+        log(" ")
+        return (getter(track), weight, getter.__name__, quote(track.fileName))
+    
+    def gettersByWeight(self):
+        """Return self.getters with the heaviest getters first.
+        
+        Getters of equal weight keep the order they were listed in."""
+        
+        return sorted(self.getters, key=lambda (getter, weight): weight, 
+                      reverse=True)
+    
+    def callGetterOnTracks(self, getter, weight, tracks):
+        """Call one getter for every track at once on the getter pool.
+        
+        Returns the rows of data for findConsensus in the order of tracks."""
+        
+        pool = getGetterPool()
+        jobs = [pool.submit(self.callGetter, getter, weight, track) 
+                for track in tracks]
+        data = []
+        try:
+            for track, job in zip(tracks, jobs):
+                with logSection("\nActing on track %s." % quote(track.fileName)):
+                    data.append(job.result())
+        finally:
+            for job in jobs:
+                job.cancel()
+        return data
+    
+    def isDecided(self, data, remainingWeight):
+        """Return True if no further results could change findConsensus's pick.
+        
+        That is the case when the leading group is ahead of the next group by 
+        more than the total weight of the getters not yet called, and the 
+        leading candidate within that group is ahead of its other spellings by
+        more than that as well."""
+        
+        groups, candidates = self.rankScores(data)
+        if not groups:
+            return False
+        
+        groupScores = [score for score, group in groups] + [0]
+        if groupScores[0] - groupScores[1] <= remainingWeight:
+            return False
+        
+        topGroup = groups[0][1]
+        memberScores = [score for score, candidate in candidates
+                        if restrictChars(candidate, punctuation=False).lower() 
+                        == topGroup] + [0]
+        return memberScores[0] - memberScores[1] > remainingWeight
+    
+    def logSkipped(self, getters):
+        """Log the getters which were not called because the result was decided."""
+        
+        log("\nThe %s is decided. Skipping: %s" 
+            % (self.fieldName, ", ".join(getter.__name__ for (getter, weight) 
+                                          in getters)))
+
     def logResults(self, results):
         """Logs the results in a tabular format."""
         
@@ -55,6 +165,26 @@ class AbstractFinder(object):
                                  fileName.ljust(maxFilename+3), 
                                  candidate if candidate else ""))
     
+    def rankScores(self, data):
+        """Sum the weights behind each group and candidate, highest first.
+        
+        Returns a list of (score, group) and a list of (score, candidate), 
+        both sorted from highest score to lowest. Null results are ignored."""
+        
+        scores = {}
+        groupScores = {}
+        for (candidate, weight, name, track) in data:
+            if candidate:
+                group = restrictChars(candidate, punctuation=False).lower()
+                scores[candidate] = scores.get(candidate, 0) + weight
+                groupScores[group] = groupScores.get(group, 0) + weight
+        
+        groups = [(score, group) for group, score in groupScores.items()]
+        groups.sort(reverse=True)
+        candidates = [(score, candidate) for candidate, score in scores.items()]
+        candidates.sort(reverse=True)
+        return groups, candidates
+    
     @logfn("\nFinding the result which received the most points.")
     def findConsensus(self, data):
         """Take data from getters and find the value with the highest score.
@@ -73,26 +203,13 @@ class AbstractFinder(object):
     
         flowcontrol.checkpoint()
         
-        # Create a dict of values to sums of weights while removing null results.
-        scores = {}
-        groupScores = {}
-        for (candidate, weight, name, track) in data:
-            if candidate:
-                group = restrictChars(candidate, punctuation=False).lower()
-                scores[candidate] = scores.get(candidate, 0) + weight
-                groupScores[group] = groupScores.get(group, 0) + weight
-                
+        groups, candidates = self.rankScores(data)
+        
         # Ensure that we have data, otherwise return None indicating failure
-        if not scores:
+        if not candidates:
             log("Unable to find consensus -- no getters returned valid results.")
             return None
         
-        # Rank the groups and the candidates
-        groups = [(score, group) for group, score in groupScores.items()]
-        groups.sort(reverse=True)
-        candidates = [(score, candidate) for candidate, score in scores.items()]
-        candidates.sort(reverse=True)
-        
         # Display candidates (and groups, if different).
         log("Candidates:")
         for score, candidate in candidates:
@@ -117,6 +234,7 @@ class AbstractFinder(object):
         
         return tagging.getTag(track.filePath, self.fieldName) or None
     
+    @uses(fuzzy=True)
     @logfn("Matching current value of tag in MusicBrainz.")
     def getMBTag(self, track):
         """Fuzzily match current value in tag using MusicBrainz."""
@@ -132,21 +250,38 @@ class AbstractFinder(object):
 
 
 class AbstractReleaseFinder(AbstractFinder):
-    """Base class for release-specific data Finders."""
+    """Base class for release-specific data Finders.
+    
+    A release-wide field should come out the same whichever track is asked,
+    so if configuration.SETTINGS["SAMPLE_ABOVE"] is set, on a release with 
+    more tracks than that only a sample of them is asked at first. The sample
+    is doubled until every track has been asked or the tracks (and getters)
+    not yet asked could not change the winner even if they all disagreed. 
+    Sampling therefore never changes the result; it only saves calls when 
+    the tracks agree."""
     
     def run(self, release):
         """Gather release data and find a consensus."""
         
         data = []
-        for track in release.tracks:
-            with logSection("\nActing on track %s." % quote(track.fileName)):
-                for (getter, weight) in self.getters:
-                        flowcontrol.checkpoint()
-                        log(" ") 
-                        data.append((getter(track), 
-                                     weight, 
-                                     getter.__name__, 
-                                     quote(track.fileName)))
+        asked = []
+        totalWeight = sum(weight for (getter, weight) in self.getters)
+        sampleSize = self.firstSampleSize(release)
+        while True:
+            sample = self.chooseSample(release.tracks, sampleSize)
+            newTracks = [track for track in sample if track not in asked]
+            asked.extend(newTracks)
+            unaskedWeight = totalWeight * (len(release.tracks) - len(asked))
+            with logSection("\nAsking about %d of the %d tracks." 
+                            % (len(asked), len(release.tracks))):
+                decided = self.gatherData(newTracks, data, unaskedWeight)
+            
+            if (decided or len(asked) == len(release.tracks) 
+                or self.isDecided(data, unaskedWeight)):
+                break
+            log("\nThe %s is not clear from this sample; asking more tracks." 
+                % self.fieldName)
+            sampleSize *= 2
         
         self.logResults(data)
         
@@ -158,28 +293,97 @@ class AbstractReleaseFinder(AbstractFinder):
             return True
         else:
             return False
+    
+    def gatherData(self, tracks, data, unaskedWeight=0):
+        """Call the getters for tracks, adding their rows to data.
+        
+        Each getter is called for every track before the next (lighter) getter
+        is tried, and no more getters are called once the consensus is 
+        decided. unaskedWeight is the weight of the tracks which are not being
+        asked yet; they could still change the consensus, so it counts against
+        deciding it. Returns True if getters were skipped because the 
+        consensus was decided."""
+        
+        getters = self.gettersByWeight()
+        for i, (getter, weight) in enumerate(getters):
+            remainingWeight = sum(w for (g, w) in getters[i:]) * len(tracks)
+            if self.isDecided(data, remainingWeight + unaskedWeight):
+                self.logSkipped(getters[i:])
+                return True
+            data.extend(self.callGetterOnTracks(getter, weight, tracks))
+        return False
+
+    def firstSampleSize(self, release):
+        """Return how many tracks to ask about first."""
+        
+        numTracks = len(release.tracks)
+        sampleAbove = configuration.SETTINGS["SAMPLE_ABOVE"]
+        if not sampleAbove or numTracks <= sampleAbove:
+            return numTracks
+        return max(1, min(numTracks, configuration.SETTINGS["SAMPLE_SIZE"]))
+    
+    def chooseSample(self, tracks, size):
+        """Return size of the tracks, in release order, picked by the sample policy.
+        
+        "spread" takes tracks evenly spaced from the first to the last, "first"
+        takes the first tracks and "random" takes them at random. A larger 
+        size picks the same tracks as a smaller one (for "spread", as far as 
+        the spacing allows), plus some more."""
+        
+        if size >= len(tracks):
+            return list(tracks)
+        
+        policy = configuration.SETTINGS["SAMPLE_POLICY"]
+        if policy == "first":
+            indices = range(size)
+        elif policy == "random":
+            indices = sorted(random.Random(len(tracks)).sample(range(len(tracks)), 
+                                                               len(tracks))[:size])
+        else:
+            if size == 1:
+                indices = [0]
+            else:
+                indices = sorted(set(i * (len(tracks) - 1) // (size - 1) 
+                                     for i in range(size)))
+        return [tracks[i] for i in indices]
 
 
 class AbstractTrackFinder(AbstractFinder):
     """Base class for track-specific data Finders."""
     
     def run(self, release):
-        """Gather track-specific data and find a consensus."""
+        """Gather track-specific data and find a consensus.
         
-        results = []
+        The getters are called heaviest first, each for all the tracks which 
+        are still undecided at once. A track stops being asked about once its
+        consensus can no longer change."""
+        
+        getters = self.gettersByWeight()
+        dataByTrack = dict((track, []) for track in release.tracks)
+        skippedByTrack = dict((track, []) for track in release.tracks)
+        for i, (getter, weight) in enumerate(getters):
+            remainingWeight = sum(w for (g, w) in getters[i:])
+            undecided = []
+            for track in release.tracks:
+                if skippedByTrack[track]:
+                    continue
+                if self.isDecided(dataByTrack[track], remainingWeight):
+                    skippedByTrack[track] = getters[i:]
+                else:
+                    undecided.append(track)
+            if not undecided:
+                break
+            data = self.callGetterOnTracks(getter, weight, undecided)
+            for track, row in zip(undecided, data):
+                dataByTrack[track].append(row)
         
+        results = []
         for track in release.tracks:
             with logSection("Attempting to determine %s for %s." % 
                             (self.fieldName, quote(track.fileName))):
-                data = []
-                for (getter, weight) in self.getters:
-                    flowcontrol.checkpoint()
-                    log(" ")
-                    data.append((getter(track), 
-                                 weight, 
-                                 getter.__name__, 
-                                 quote(track.fileName)))
-                                    
+                if skippedByTrack[track]:
+                    self.logSkipped(skippedByTrack[track])
+                data = dataByTrack[track]
                 self.logResults(data)
                 
                 consensus = self.findConsensus(data)
@@ -26,7 +26,7 @@ from etc import functions
 from etc.logger import log, logfn, logSection
 from etc.utils import *
 
-from AbstractFinder import AbstractReleaseFinder
+from AbstractFinder import AbstractReleaseFinder, uses
 
 class ArtistFinder(AbstractReleaseFinder):
     """Gatherer of artist data from all available sources.
@@ -63,6 +63,7 @@ class ArtistFinder(AbstractReleaseFinder):
 
         return mb.getMBPUID(track.musicDNS["puid"], "artist")
     
+    @uses("release", "date", "tracktotal", "title")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -84,6 +85,7 @@ class ArtistFinder(AbstractReleaseFinder):
             
         return result
     
+    @uses("release", "date", "tracktotal", fuzzy=True)
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -105,6 +107,7 @@ class ArtistFinder(AbstractReleaseFinder):
         
         return result
     
+    @uses("date", fuzzy=True)
     @logfn("Matching the filepath to a MusicBrainz artist.")
     def getMBFilename(self, track):
         """Try to match the file name to an artist using MB."""
@@ -25,7 +25,7 @@ from metadata import musicbrainz as mb
 from etc import functions
 from etc.logger import log, logfn, logSection
 
-from AbstractFinder import AbstractReleaseFinder
+from AbstractFinder import AbstractReleaseFinder, uses
 
 class DateFinder(AbstractReleaseFinder):
     """Gatherer of date data from all available sources.
@@ -52,6 +52,7 @@ class DateFinder(AbstractReleaseFinder):
 
         return track.musicDNS["year"]
     
+    @uses("release", "artist", "tracktotal")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -72,6 +73,7 @@ class DateFinder(AbstractReleaseFinder):
         
         return result
     
+    @uses("release", "artist", "tracktotal")
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -26,7 +26,7 @@ from etc import functions
 from etc.logger import log, logfn, logSection
 from etc.utils import *
 
-from AbstractFinder import AbstractReleaseFinder
+from AbstractFinder import AbstractReleaseFinder, uses
 
 class ReleaseFinder(AbstractReleaseFinder):
     """Gatherer of release data from all available sources.
@@ -48,6 +48,7 @@ class ReleaseFinder(AbstractReleaseFinder):
                         (self.getMBFilename, 4),
                         (self.getMBFilenameKnownData, 7)]
     
+    @uses("artist", "date", "title", "tracktotal")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -68,6 +69,7 @@ class ReleaseFinder(AbstractReleaseFinder):
         
         return result
     
+    @uses("artist", "date", "title", "tracktotal", fuzzy=True)
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -91,6 +93,7 @@ class ReleaseFinder(AbstractReleaseFinder):
         
         return result
 
+    @uses("date", fuzzy=True)
     @logfn("Matching the filepath to a MusicBrainz release.")
     def getMBFilename(self, track):
         """Attempt to fuzzily match release name from filepath using MusicBrainz.
@@ -100,6 +103,7 @@ class ReleaseFinder(AbstractReleaseFinder):
         folderFilePath = self.getFilenameForMB(track)
         return mb.askMB(self.fieldName, folderFilePath, track)
 
+    @uses("artist", "date", "title", "tracktotal", fuzzy=True)
     @logfn("Matching the filepath to a MusicBrainz release using known data.")
     def getMBFilenameKnownData(self, track):
         """Attempt to fuzzily match release name from filepath using MusicBrainz.
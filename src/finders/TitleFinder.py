@@ -25,7 +25,7 @@ from metadata import musicbrainz as mb
 from etc.logger import log, logfn, logSection
 from etc.utils import *
 
-from AbstractFinder import AbstractTrackFinder
+from AbstractFinder import AbstractTrackFinder, uses
 
 class TitleFinder(AbstractTrackFinder):
     """Gatherer of title data from all available sources.
@@ -62,6 +62,7 @@ class TitleFinder(AbstractTrackFinder):
 
         return mb.getMBPUID(track.musicDNS["puid"], "title")
     
+    @uses("release", "tracknumber", "date", "artist", "tracktotal")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -85,6 +86,7 @@ class TitleFinder(AbstractTrackFinder):
         
         return result
     
+    @uses("release", "tracknumber", "artist", fuzzy=True)
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -107,6 +109,7 @@ class TitleFinder(AbstractTrackFinder):
         
         return result
     
+    @uses("tracknumber", fuzzy=True)
     @logfn("Matching the filename to a title using MusicBrainz.")
     def getMBFilename(self, track):
         """Try to match the file name to a title using MB."""
@@ -114,6 +117,7 @@ class TitleFinder(AbstractTrackFinder):
         fileName = self.getFilenameForMB(track)
         return mb.askMB(self.fieldName, fileName, track)
 
+    @uses("release", "tracknumber", "artist", fuzzy=True)
     @logfn("Matching the filename with MusicBrainz using the known data.")
     def getMBFilenameKnownData(self, track):
         """Try to match the file name to a title using MB."""
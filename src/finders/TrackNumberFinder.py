@@ -24,7 +24,7 @@ from metadata import musicbrainz as mb
 from etc.logger import log, logfn, logSection
 
 from AbstractFinder import AbstractFinder
-from AbstractFinder import AbstractTrackFinder
+from AbstractFinder import AbstractTrackFinder, uses
 
 class TrackNumberFinder(AbstractTrackFinder):
     """Gatherer of track number data from all available sources.
@@ -45,6 +45,7 @@ class TrackNumberFinder(AbstractTrackFinder):
                         (self.getFilename, 3),
                         (self.getMBFilenameKnownData, 3)]
     
+    @uses("title", "artist", "release")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -65,6 +66,7 @@ class TrackNumberFinder(AbstractTrackFinder):
             
         return result
     
+    @uses("title", "artist", "release")
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -106,6 +108,7 @@ class TrackNumberFinder(AbstractTrackFinder):
         else:
             return None
         
+    @uses("title", "artist", "release")
     @logfn("Matching track number from filename with MusicBrainz and known data.")
     def getMBFilenameKnownData(self, track):
         """Match track number from filename against MB using known data."""
@@ -21,7 +21,7 @@ from metadata import tagging
 from metadata import musicbrainz as mb
 from etc.logger import log, logfn, logSection
 
-from AbstractFinder import AbstractReleaseFinder
+from AbstractFinder import AbstractReleaseFinder, uses
 
 class TrackTotalFinder(AbstractReleaseFinder):
     """Gatherer of track total data from all available sources.
@@ -42,6 +42,7 @@ class TrackTotalFinder(AbstractReleaseFinder):
                         (self.getNumTracksInDir, 2),
                         (self.getMBNumTracksInDir, 6)]
     
+    @uses("release", "artist", "date")
     @logfn("Searching MusicBrainz with the currently known data.")
     def getMBKnownData(self, track):
         """Query MB using known data.
@@ -62,6 +63,7 @@ class TrackTotalFinder(AbstractReleaseFinder):
 
         return result
     
+    @uses("release", "artist", "date")
     @logfn("Matching the current tag value with MusicBrainz using known data.")
     def getMBTagKnownData(self, track):
         """Query MB using known data and the current tag."""
@@ -91,6 +93,7 @@ class TrackTotalFinder(AbstractReleaseFinder):
         
         return unicode(len(track.parent.tracks)).zfill(2)
     
+    @uses("release", "artist", "date")
     @logfn("Matching the track count with MusicBrainz using the known data.")
     def getMBNumTracksInDir(self, track):
         """See if the number of tracks in the directory matches with MB."""
@@ -37,6 +37,12 @@ def run(argv):
                       default=True, help="run program without GUI (on by default)")
     parser.add_option("-s", metavar="SORTED_DIR", dest="sortedPath", 
                       help="the directory correctly sorted music should be moved to")
+    parser.add_option("--watch", action="store_true", dest="watch", 
+                      default=False, help="keep running without GUI, handling "
+                      "new arrivals in the input directories once they settle")
+    parser.add_option("--organize", action="store_true", dest="organize",
+                      default=False, help="link sorted music into SORTED_DIR, "
+                      "leaving the input directories untouched")
     options, inputPaths = parser.parse_args(argv)
     
     configuration.loadConfigFile()
@@ -44,8 +50,16 @@ def run(argv):
         configuration.PATHS["SORTED"] = toUnicode(options.sortedPath)
     if inputPaths:
         configuration.PATHS["TO_SCAN"] = [toUnicode(path) for path in inputPaths]
+    if options.organize:
+        configuration.SETTINGS["ORGANIZE"] = True
     
-    if options.showGUI:
+    if options.watch:
+        from filehandling import watch
+        
+        logOutputs.append(sys.stdout)
+        watch.watch()
+        
+    elif options.showGUI:
         from PyQt4.QtGui import QApplication
         from gui.MainWindow import MainWindow
         
@@ -35,9 +35,12 @@ The design of the ReleaseManager + Finders architecture is intended to
 maximize our chances of finding all needed metadata. One of the key method
 is to use a queue of Finder objects, one for each field that we do not yet
 know. If a Finder fails to find the metadata for that field, then that
-Finder is placed at the end of the queue to be tried again. The hope is that
-by that time other fields will become known and this known data will allow
-us to determine the field which we previously could not. 
+Finder stays in the queue to be tried again. The hope is that other fields 
+will become known and this known data will allow us to determine the field 
+which we previously could not. Each getter declares the known fields it uses
+(see AbstractFinder.uses), so a failed Finder is only tried again once one of
+the fields it depends on has actually been determined, and the process stops
+as soon as no waiting Finder has anything new to work with.
 
 
 The Picture
@@ -58,11 +61,13 @@ illustrated below. Each component uses the component(s) in the box below it.
 """
 
 import shutil
+import threading
 from collections import defaultdict
 
 from etc import flowcontrol
 from etc import functions
 from etc import configuration
+from etc import journal
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
@@ -77,6 +82,10 @@ from finders.GenreFinder import GenreFinder
 import fingerprint
 import tagging
 
+# The MusicDNS library is initialized and finalized around each release's 
+# fingerprinting and is not safe to use from several threads at once.
+musicdnsLock = threading.Lock()
+
 class ReleaseManagerError(Exception):
     """Raised when a problem will keep the release from being tagged."""
 
@@ -91,16 +100,71 @@ class ReleaseManager(object):
         self.queue = [ArtistFinder(), ReleaseFinder(), DateFinder(), 
                       TrackTotalFinder(), TrackNumberFinder(), TitleFinder(), 
                       GenreFinder()]
-        self.nextRoundQueue = []
+        self.resumed = False
+        
+    def resume(self):
+        """Take up the results of an interrupted run from the journal, if any.
+        
+        If the release had been identified, the metadata found then is used 
+        instead of identifying it again, and tracks whose tags and filenames
+        were written then are not written again. The results are only used if
+        the tracks they describe are the audio files now in the directory."""
+        
+        directoryPath = self.release.directoryPath
+        entry = journal.getEntry(directoryPath)
+        if "identify" not in entry:
+            return
+        
+        if "move" in entry:
+            # Every track was written and some may have been moved already.
+            tracks = list(self.release.tracks)
+            for track in tracks:
+                track.written = True
+        else:
+            tracks = []
+            written = entry["tag"]
+            for filePath, metadata in entry["identify"]["tracks"].items():
+                track = Track(self.release, written.get(filePath, filePath))
+                track.metadata = metadata
+                track.written = filePath in written
+                tracks.append(track)
+            if (set(track.filePath for track in tracks) != 
+                set(track.filePath for track in self.release.tracks)):
+                log("\nThe audio in %s has changed since it was identified in "
+                    "an interrupted run." % quote(directoryPath))
+                return
+        
+        log("\nUsing the metadata found for %s in an interrupted run." % 
+            quote(directoryPath))
+        self.release.metadata = entry["identify"]["release"]
+        self.release.tracks = TrackList(sorted(tracks, 
+                                               key=lambda track: track.filePath))
+        self.resumed = True
         
     def run(self):
         """Fingerprint audio, find metadata, check sanity, write tags and filenames."""
 
-        if configuration.SETTINGS["GET_PRINT"]:
+        self.fingerprint()
+        self.identify()
+        self.writeResults()
+        
+    def fingerprint(self):
+        """Fingerprint the audio, if the user has asked for it."""
+        
+        if configuration.SETTINGS["GET_PRINT"] and not self.resumed:
             self.getMusicDNS()
+            
+    def identify(self):
+        """Find the metadata and check it; raise ReleaseManagerError on failure."""
+        
+        if self.resumed:
+            return
         self.gatherMetadata()
         self.checkSanity()
-        self.writeResults()
+        journal.record(self.release.directoryPath, "identify", 
+                       release=self.release.metadata,
+                       tracks=dict((track.filePath, track.metadata) 
+                                   for track in self.release.tracks))
         
     def logInitialState(self):
         """Log the initial state of the filenames, tags and MusicDNS results.
@@ -115,38 +179,63 @@ class ReleaseManager(object):
         """Fingerprint each track and look for matches in MusicDNS."""
         
         import musicdns
-        musicdns.initialize()
-        for track in self.release.tracks:
-            track.getMusicDNS()
-        musicdns.finalize()
+        with musicdnsLock:
+            musicdns.initialize()
+            try:
+                for track in self.release.tracks:
+                    track.getMusicDNS()
+            finally:
+                musicdns.finalize()
 
     @logfn("\nGathering metadata.")
     def gatherMetadata(self):
-        """Iterate through Finders until success or stagnation."""
+        """Run Finders until all succeed or none of them can make progress.
+        
+        Every Finder is run once. After that a Finder which failed is only run
+        again when one of the fields its getters depend on has become known 
+        since its last run; rerunning it with the same known data would just 
+        repeat the same queries and reach the same result."""
 
+        knownFields = set()
+        knownAtLastRun = {}
+        
         while self.queue:
-            for finder in self.queue:
+            ranFinder = False
+            for finder in self.queue[:]:
                 field = finder.fieldName
                 
+                if finder in knownAtLastRun:
+                    newlyKnown = ((knownFields - knownAtLastRun[finder]) 
+                                  & finder.dependencies())
+                    if not newlyKnown:
+                        continue
+                    log("Trying the %s again now that the %s %s known." 
+                        % (field, ", ".join(sorted(newlyKnown)), 
+                           "is" if len(newlyKnown) == 1 else "are"))
+                
+                knownAtLastRun[finder] = set(knownFields)
+                ranFinder = True
                 with logSection("\nAttempting to determine the %s using %d sources." 
                                 % (field, len(finder.getters))):
                     success = finder.run(self.release)
                 
                 if not success:
-                    log("Failed to determine the %s. Will try again next round.\n"
-                        % field)
-                    self.nextRoundQueue.append(finder)
+                    waitingOn = sorted(finder.dependencies() - knownFields)
+                    if waitingOn:
+                        log("Failed to determine the %s. Will try again if the "
+                            "%s becomes known.\n" % (field, " or ".join(waitingOn)))
+                    else:
+                        log("Failed to determine the %s.\n" % field)
                 else:
                     log("Successfully determined the %s.\n" % field)
+                    knownFields.add(field)
+                    self.queue.remove(finder)
             
-            if self.queue == self.nextRoundQueue:
-                log("No progress has been made. The metadata gathering process "
+            if self.queue and not ranFinder:
+                log("No progress can be made. The metadata gathering process "
                     "has failed.\n")
                 failedFields = [finder.fieldName for finder in self.queue]
                 raise ReleaseManagerError, "Unable to determine: %s" % failedFields
-            else:
-                self.queue = self.nextRoundQueue
-                self.nextRoundQueue = []
         
     @logfn("\nChecking for errors in the results.")
     def checkSanity(self):
@@ -212,9 +301,14 @@ class ReleaseManager(object):
 
         flowcontrol.checkpoint()
         for track in self.release.tracks:
+            if track.written:
+                continue
             flowcontrol.checkpoint(pauseOnly=True)
+            originalPath = track.filePath
             track.writeTags()
             track.rename()
+            journal.record(self.release.directoryPath, "tag", 
+                           track=originalPath, newPath=track.filePath)
             log(" ")
             
     def getNewPath(self):
@@ -266,6 +360,7 @@ class Track(object):
         self.metadata = {}
         self.filePath = filePath
         self.fileName = os.path.basename(filePath)
+        self.written = False
         self.musicDNS = defaultdict(lambda: None) # Returns None for all look-ups.
 
     def getMusicDNS(self):
@@ -282,14 +377,12 @@ class Track(object):
     
     @logfn("Writing tags for {quote(self.fileName)}.")
     def writeTags(self):
-        """Clear the current track tags and write what we've found."""
+        """Replace the current track tags with what we've found."""
 
-        log("Clearing current tags.")
-        tagging.clearTags(self.filePath)
-        log("Writing these tags:")
+        log("Replacing current tags with these tags:")
         for field in self.metadata:
             log("    %s%s" % (field.ljust(20), self.metadata[field]))
-            tagging.setTag(self.filePath, field, self.metadata[field])
+        tagging.writeTags(self.filePath, self.metadata)
 
     @logfn("Writing filename for {quote(self.fileName)}.")
     def rename(self):
@@ -298,10 +391,12 @@ class Track(object):
         newBaseName = self.metadata["tracknumber"].rjust(2, u"0")
         newBaseName += " - " + translateForFilename(self.metadata["title"])
         oldBaseName, ext = os.path.splitext(self.fileName)
-        newPath = self.filePath.replace(oldBaseName, newBaseName)
+        newPath = os.path.join(os.path.dirname(self.filePath), newBaseName + ext)
         if not os.path.exists(newPath):
             log("Renaming %s to %s." % (quote(oldBaseName), quote(newBaseName)))
             shutil.move(self.filePath, newPath)
+            self.filePath = newPath
+            self.fileName = os.path.basename(newPath)
         elif newBaseName == oldBaseName:
             log("Old filename is correct. No renaming necessary.")
         else:
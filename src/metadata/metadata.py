@@ -21,11 +21,16 @@
 
 This file instantiates a ReleaseManager object then invokes its mainloop. If a
 ReleaseManagerError is raised, indicating we could not fill an essential field,
-then the directory is rejected, otherwise it is accepted."""
+then the directory is rejected, otherwise it is accepted.
+
+The pipeline in traverse runs the ReleaseManager's steps as separate stages 
+instead, using createReleaseManager and fileRelease directly."""
 
 import Manager
+import tagging
 
 from etc import functions
+from etc import journal
 from etc.utils import *
 from etc.logger import log, logfn, logSection
 
@@ -33,13 +38,42 @@ from etc.logger import log, logfn, logSection
 def handleMetadata(directoryPath, audioFilePaths):
     """Create and run a ReleaseManager object."""
     
-    releaseManager = Manager.ReleaseManager(directoryPath, audioFilePaths)
+    releaseManager = createReleaseManager(directoryPath, audioFilePaths)
     try:
         releaseManager.run()
     except Manager.ReleaseManagerError, e:
+        fileRelease(directoryPath, releaseManager, e)
+    else:
+        fileRelease(directoryPath, releaseManager)
+
+def createReleaseManager(directoryPath, audioFilePaths):
+    """Start loading the tags of the audio; return a ReleaseManager for it.
+    
+    The ReleaseManager picks up where an interrupted run left off, if one did."""
+    
+    tagging.readAhead(audioFilePaths)
+    releaseManager = Manager.ReleaseManager(directoryPath, audioFilePaths)
+    releaseManager.resume()
+    return releaseManager
+
+def fileRelease(directoryPath, releaseManager, error=None):
+    """Accept the directory, or reject it if the ReleaseManager raised error."""
+    
+    if error:
         log("\nCould not identify and tag audio.")
-        log(str(e))
+        log(str(error))
         functions.rejectItem(directoryPath)
     else:
         log("\nDirectory has been sorted successfully.")
-        functions.acceptItem(directoryPath, releaseManager.getNewPath())
+        newPath = releaseManager.getNewPath()
+        journal.record(directoryPath, "move", destination=newPath)
+        functions.acceptItem(directoryPath, newPath)
+
+def readAhead(inventory):
+    """Start loading the tags of the audio in a directory in the background.
+    
+    Takes the directory's Inventory. This is called on the directory that will
+    be handled next, so that its files are read while the current directory 
+    waits on the network."""
+    
+    tagging.readAhead(inventory.filePathsByType.get("good_audio", []))
@@ -17,38 +17,146 @@
 #  You should have received a copy of the GNU General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-"""Functions for reading and writing MP3 and Ogg Vorbis tags.
+"""Functions for reading and writing MP3, Ogg Vorbis, Opus, FLAC and MP4 tags.
 
-This file provides only three functions which are called from other files:
-getTag, setTag and clearTags. All the other functions all called by these
-three to help in those tasks."""
+This file provides four functions which are called from other files:
+getTag, setTag, clearTags and writeTags. All the other functions all called by
+these four to help in those tasks.
+
+Reading a tag only parses the tag itself (the ID3 header, the Vorbis comment 
+packet or the FLAC/MP4 metadata blocks) through readTags. Nothing seeks into the
+audio to work out its duration or bitrate.
+
+Tags can also be answered from memory: readAhead loads the tags of a whole 
+directory of files in background threads into a table, which readTags 
+consults first.
+
+getTag and setTag each open the file, and setTag saves it, every time they are
+called. writeTags is what should be used when writing a track's final results:
+it builds the complete tag set in memory and saves the file exactly once.
+
+Every save goes through saveTags, which asks Mutagen to write the new tags into
+the space (the padding) left by the old ones. Only when the new tags do not fit
+does the file grow, and then configuration.SETTINGS["TAG_PADDING"] bytes are
+reserved so the next retagging fits. Growing or shrinking the tag block means 
+rewriting the whole audio file, so this matters a lot on network storage."""
 
 import os
+import threading
 from pprint import pprint
+from collections import OrderedDict
 
 import mutagen.id3
-from mutagen.mp3 import MP3
+from mutagen.mp3 import MP3, HeaderNotFoundError
 from mutagen.oggvorbis import OggVorbis as Ogg
+from mutagen.oggvorbis import OggVorbisInfo, OggVCommentDict
+from mutagen.flac import FLAC
 from mutagen.easyid3 import EasyID3
 
+try:
+    from mutagen.oggopus import OggOpus, OggOpusInfo, OggOpusVComment
+except ImportError:
+    OggOpus = None
+
+try:
+    from mutagen.easymp4 import EasyMP4
+except ImportError:
+    EasyMP4 = None
+
+from etc import configuration
+from etc import transfer
 from etc.utils import *
+from etc.workers import WorkerPool
 from etc.logger import log, logfn, logSection
 
+# Choosing the padding when saving was added in Mutagen 1.31.
+paddingSupported = mutagen.version >= (1, 31)
+
+#-------------------------------------------
+# Supported Formats
+#-------------------------------------------
+# Each format maps an extension to the Mutagen class used to open it and to
+# the names that format uses for Audiolog's fields. Fields which are not in a
+# format's map are stored under their own name.
+#
+# ID3 and MP4 store the track number and total together in one "tracknumber"
+# field, so they have no name for "tracktotal" at all; see the combined track
+# helper functions below. Vorbis comments (Ogg Vorbis, Opus and FLAC) store 
+# them as two separate fields.
+#-------------------------------------------
+
+vorbisFields = {"release": "album"}
+id3Fields = {"release": "album", "tracktotal": None}
+mp4Fields = {"release": "album", "tracktotal": None}
+
+formats = {".mp3" : (lambda filePath: MP3(filePath, ID3=EasyID3), id3Fields),
+           ".ogg" : (Ogg, vorbisFields),
+           ".flac": (FLAC, vorbisFields)}
+
+if OggOpus:
+    formats[".opus"] = (OggOpus, vorbisFields)
+if EasyMP4:
+    formats[".m4a"] = (EasyMP4, mp4Fields)
+
+# Opus and M4A files are bad_audio, and converted, unless they can be tagged.
+for extension in (".opus", ".m4a"):
+    if extension in formats:
+        configuration.setFileType(extension, "good_audio")
+
+#-------------------------------------------
+# Header-Only Tag Readers
+#-------------------------------------------
+# Opening a file with its Mutagen class also parses the audio stream: MP3 
+# scans for the first MPEG frame and the Ogg classes seek to the last page to
+# find the length. When only the tags are wanted these readers parse just the
+# tag data at the start of the file. Formats without a reader here (FLAC and
+# MP4) already keep their tags in metadata blocks ahead of the audio, so their
+# Mutagen class is used as is.
+#-------------------------------------------
+
+def readID3Tags(filePath):
+    try:
+        return EasyID3(filePath)
+    except mutagen.id3.ID3NoHeaderError:
+        return {}
+    
+def readOggTags(filePath, Info, Comment):
+    fileobj = open(filePath, "rb")
+    try:
+        return Comment(fileobj, Info(fileobj))
+    finally:
+        fileobj.close()
+
+tagReaders = {".mp3": readID3Tags,
+              ".ogg": lambda filePath: readOggTags(filePath, OggVorbisInfo, 
+                                                  OggVCommentDict)}
+
+if OggOpus:
+    tagReaders[".opus"] = lambda filePath: readOggTags(filePath, OggOpusInfo, 
+                                                      OggOpusVComment)
+
+def hasCombinedTrackField(filePath):
+    """Return True if the format stores tracknumber and tracktotal together."""
+    
+    fieldMap = formats.get(ext(filePath), (None, {}))[1]
+    return "tracktotal" in fieldMap and fieldMap["tracktotal"] is None
+
 #-------------------------------------------
-# MP3 Track Number and Total Helper Functions
+# Combined Track Number and Total Helper Functions
 #-------------------------------------------
 # These helper functions are dedicated to making reading and writing 
-# track numbers and track totals to MP3s work like performing those actions on
-# Ogg Vorbis files. These behave differently because Ogg Vorbis, preferably, 
-# stores the tracknumber and tracktotal as two separate fields, whereas MP3
-# stores them as a combined "tracknumber" field which might look like "08/12", 
-# for example. The MP3 helper functions work be reading the combined track
-# field; splitting based on the "/" character into track number and total;
-# then, in the case of reading, returning the relevant part; or, in the case of
-# writing, by writing the relevant part while keeping the other part constant.
+# track numbers and track totals to MP3s and MP4s work like performing those 
+# actions on Vorbis comments. These behave differently because Vorbis comments,
+# preferably, store the tracknumber and tracktotal as two separate fields, 
+# whereas ID3 and MP4 store them as a combined "tracknumber" field which might 
+# look like "08/12", for example. The helper functions work be reading the 
+# combined track field; splitting based on the "/" character into track number 
+# and total; then, in the case of reading, returning the relevant part; or, in
+# the case of writing, by writing the relevant part while keeping the other 
+# part constant.
 #-------------------------------------------
 
-def getMP3TrackTotal(filePath):
+def getCombinedTrackTotal(filePath):
     combinedTrackData = getTag(filePath, "tracknumber", True)
     listed = combinedTrackData.split("/")
     if len(listed) == 2:
@@ -56,18 +164,18 @@ def getMP3TrackTotal(filePath):
     else:
         return u""
 
-def getMP3TrackNumber(filePath):
+def getCombinedTrackNumber(filePath):
     combinedTrackData = getTag(filePath, "tracknumber", True)
     listed = combinedTrackData.split("/")
     return listed[0]
 
-def setMP3TrackTotal(filePath, value):
+def setCombinedTrackTotal(filePath, value):
     combinedTrackData = getTag(filePath, "tracknumber", True)
     listed = combinedTrackData.split("/")
     trackData = u"/".join([listed[0], value])
     setTag(filePath, "tracknumber", trackData, True)
         
-def setMP3TrackNumber(filePath, value):
+def setCombinedTrackNumber(filePath, value):
     combinedTrackData = getTag(filePath, "tracknumber", True)
     listed = combinedTrackData.split("/")
     if len(listed) == 2:
@@ -76,35 +184,185 @@ def setMP3TrackNumber(filePath, value):
     else:
         setTag(filePath, "tracknumber", value, True)
 
+def combineTrackFields(tags):
+    """Fold the tracknumber and tracktotal of a tag dict into one field.
+    
+    This is the in-memory equivalent of setCombinedTrackNumber and 
+    setCombinedTrackTotal used by writeTags. An unknown track number is written
+    as "00", even when there is no track total either, which is what clearTags
+    leaves behind."""
+    
+    tracktotal = tags.pop("tracktotal", None)
+    tracknumber = tags.pop("tracknumber", None) or u"00"
+    if tracktotal:
+        tags["tracknumber"] = u"/".join([tracknumber, tracktotal])
+    else:
+        tags["tracknumber"] = tracknumber
+
 #-------------------------------------------
 # General Helper Functions
 #-------------------------------------------
 
-def validField(field):
-    """Convert MusicBrainz terminology to valid Mutagen terminology."""
+def validField(field, filePath):
+    """Convert Audiolog terminology to the file format's Mutagen terminology."""
     
-    if field == "release": 
-        return "album"
-    else: 
-        return field
+    fieldMap = formats[ext(filePath)][1]
+    return fieldMap.get(field, field)
 
 def openAudioFile(filePath):
-    """Return, based on extension, an MP3 or Ogg Mutagen object."""
+    """Return, based on extension, the appropriate Mutagen object."""
     
     extension = ext(filePath)    
     try:
-        if extension == ".mp3":
-            return MP3(filePath, ID3=EasyID3)
-        elif extension == ".ogg":
-            return Ogg(filePath)
+        if extension in formats:
+            return formats[extension][0](filePath)
         else:
-            log("Cannot access %s tags. File must be an MP3 or Ogg." % quote(filePath))
-            # TODO: There's no good reason not to support other formats.
-            # Mutagen supports lots of formats.
+            log("Cannot access %s tags. File must be one of: %s." % 
+                (quote(filePath), ", ".join(sorted(formats))))
             raise NotImplementedError
     except HeaderNotFoundError:
         log("Could not open %s. File seems corrupted." % quote(filePath))
 
+def choosePadding(info):
+    """Return how much padding Mutagen should leave after the new tags.
+    
+    info is a Mutagen PaddingInfo. If the new tags fit in the existing tag
+    block (info.padding is the space that would be left over) the leftover is
+    kept so the tags can be rewritten in place. Otherwise the file has to be
+    rewritten anyway and the configured amount of padding is reserved."""
+    
+    if info.padding >= 0:
+        return info.padding
+    return configuration.SETTINGS["TAG_PADDING"]
+
+def saveTags(tagsOrFile, *args, **kwargs):
+    """Save a Mutagen file or tag object, reusing its existing padding.
+    
+    In organize mode the file is first given its own copy of its data, so
+    that the original it is linked to keeps its tags (see etc.transfer)."""
+    
+    if configuration.SETTINGS["ORGANIZE"]:
+        transfer.unshare(args[0] if args else tagsOrFile.filename)
+    if paddingSupported:
+        kwargs["padding"] = choosePadding
+    tagsOrFile.save(*args, **kwargs)
+
+def readTags(filePath):
+    """Return the file's tags, read without parsing the audio stream.
+    
+    The result behaves like a dict of Mutagen field names to lists of values.
+    If the file has no tags, an empty dict is returned."""
+    
+    tags = getReadAhead(filePath)
+    if tags is not None:
+        return tags
+    return readFileTags(filePath)
+
+def readFileTags(filePath):
+    """Read the file's tags from the file itself (see readTags)."""
+    
+    extension = ext(filePath)
+    if extension in tagReaders:
+        return tagReaders[extension](filePath)
+    
+    audioFile = openAudioFile(filePath)
+    if audioFile is None or audioFile.tags is None:
+        return {}
+    return audioFile.tags
+
+#-------------------------------------------
+# Read-Ahead Table
+#-------------------------------------------
+# Reading tags one file at a time, when a Finder first asks for one, means
+# waiting on the disk (or the network mount) over and over. readAhead instead
+# queues every file of a directory on a pool of threads, each of which reads
+# the file's tags (as readTags does, without parsing the audio) into the table
+# below.
+#
+# Entries are keyed by the file's signature (device, inode, size and mtime)
+# rather than its path. Renaming a file, as standardizeFilenames does after a 
+# directory has been read ahead, keeps the entry valid, while any change to 
+# the file's contents makes it miss. Writing tags through this module always
+# changes the mtime, but the entry is also dropped right away.
+#-------------------------------------------
+
+readAheadPool = None
+readAheadTable = OrderedDict()      # File signature -> Job returning tags
+readAheadLock = threading.Lock()
+maxReadAheadEntries = 5000
+
+def fileSignature(filePath):
+    """Return a tuple which changes whenever the file's contents change."""
+    
+    st = os.stat(filePath)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+def loadTags(filePath):
+    """Read the file's tags; return them as a dict, or None if that fails."""
+    
+    if ext(filePath) not in formats:
+        return None
+    try:
+        fileTags = readFileTags(filePath)
+    except Exception:
+        return None
+    
+    tags = {}
+    for field in fileTags.keys():
+        tags[field] = list(fileTags[field])
+    return tags
+
+def readAhead(filePaths):
+    """Start loading the tags of all the files in the background.
+    
+    This returns immediately. Files already in the table are skipped."""
+    
+    global readAheadPool
+    
+    with readAheadLock:
+        if not readAheadPool:
+            readAheadPool = WorkerPool(configuration.SETTINGS["READ_AHEAD_THREADS"])
+        
+        for filePath in filePaths:
+            try:
+                signature = fileSignature(filePath)
+            except OSError:
+                continue
+            # A failed load (say, the file was renamed before it was opened) 
+            # is retried rather than remembered.
+            job = readAheadTable.get(signature)
+            if not job or (job.done() and job.result() is None):
+                readAheadTable[signature] = readAheadPool.submit(loadTags, 
+                                                                 filePath)
+            
+        while len(readAheadTable) > maxReadAheadEntries:
+            readAheadTable.popitem(last=False)
+    
+def getReadAhead(filePath):
+    """Return the file's tags from the read-ahead table or None.
+    
+    If the file is still being read, this waits for it."""
+    
+    try:
+        signature = fileSignature(filePath)
+    except OSError:
+        return None
+    
+    with readAheadLock:
+        job = readAheadTable.get(signature)
+    return job.result() if job else None
+
+def forgetReadAhead(filePath):
+    """Drop the file's entry from the read-ahead table."""
+    
+    try:
+        signature = fileSignature(filePath)
+    except OSError:
+        return
+    
+    with readAheadLock:
+        readAheadTable.pop(signature, None)
+
 #-------------------------------------------
 # Public Functions
 #-------------------------------------------
@@ -112,41 +370,69 @@ def openAudioFile(filePath):
 def getTag(filePath, field, passThrough=False):
     """Return the specific tag for filePath."""
     
-    if field == "tracktotal" and ext(filePath) == ".mp3":
-        return getMP3TrackTotal(filePath)
-    elif field == "tracknumber" and ext(filePath) == ".mp3" and not passThrough:
-        return getMP3TrackNumber(filePath)
+    if field == "tracktotal" and hasCombinedTrackField(filePath):
+        return getCombinedTrackTotal(filePath)
+    elif (field == "tracknumber" and hasCombinedTrackField(filePath) 
+          and not passThrough):
+        return getCombinedTrackNumber(filePath)
     else:
-        field = validField(field)
-        audioFile = openAudioFile(filePath)
-        return toUnicode(audioFile.get(field, [u""])[0])
+        field = validField(field, filePath)
+        tags = readTags(filePath)
+        return toUnicode(tags.get(field, [u""])[0])
 
 def setTag(filePath, field, value, passThrough=False):
     """Set the specified field to value for filePath."""
     
-    if field == "tracktotal" and ext(filePath) == ".mp3":
-        setMP3TrackTotal(filePath, value)
-    elif field == "tracknumber" and ext(filePath) == ".mp3" and not passThrough:
-        setMP3TrackNumber(filePath, value)
+    if field == "tracktotal" and hasCombinedTrackField(filePath):
+        setCombinedTrackTotal(filePath, value)
+    elif (field == "tracknumber" and hasCombinedTrackField(filePath) 
+          and not passThrough):
+        setCombinedTrackNumber(filePath, value)
     else:
-        field = validField(field)
+        field = validField(field, filePath)
+        forgetReadAhead(filePath)
         audioFile = openAudioFile(filePath)
         audioFile[field] = toUnicode(value)
-        audioFile.save()
+        saveTags(audioFile)
     
 def clearTags(filePath):
-    """Remove all tags from file."""
+    """Remove all tags from file.
     
-    audioFile = openAudioFile(filePath)
-    audioFile.delete()
+    The tags are emptied rather than deleted so that the tag block, and its
+    padding, stays where it is for the tags written next. Formats with a
+    combined track field (MP3 and M4A) are left with a placeholder track 
+    number of "00" (see combineTrackFields)."""
     
-    if ext(filePath) == ".ogg":
-        return # If this is an Ogg, then we've done everything we need to do.
+    writeTags(filePath, {})
+
+def writeTags(filePath, tags):
+    """Replace all of the file's tags with the given fields in a single write.
     
-    audioFile = openAudioFile(filePath)
-    try:
-        audioFile.add_tags(ID3=EasyID3)
-        audioFile["tracknumber"] = u"00"
-        audioFile.save()
-    except mutagen.id3.error:
-        log("There was an error clearing the old ID3 tags.")
+    tags is a dict of fields to values. The new tags are built from scratch in
+    memory, so nothing from the old tags survives (just as if clearTags had been
+    called first) but the file is opened once and saved once, rather than once 
+    for clearing and once more for every field."""
+    
+    forgetReadAhead(filePath)
+    tags = dict(tags)
+    if hasCombinedTrackField(filePath):
+        combineTrackFields(tags)
+        
+    if ext(filePath) == ".mp3":
+        # A fresh EasyID3 replaces the whole ID3v2 tag when saved over the old
+        # one and v1=0 drops any ID3v1 tag, like MP3.delete does.
+        fileTags = EasyID3()
+    else:
+        audioFile = openAudioFile(filePath)
+        if audioFile.tags is None:
+            audioFile.add_tags()
+        fileTags = audioFile.tags
+        fileTags.clear()
+    
+    for field in tags:
+        fileTags[validField(field, filePath)] = toUnicode(tags[field])
+    
+    if ext(filePath) == ".mp3":
+        saveTags(fileTags, filePath, v1=0)
+    else:
+        saveTags(audioFile)
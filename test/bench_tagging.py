@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Benchmark: count the full-file rewrites caused by retagging.
+
+Whenever a tag block grows or shrinks, Mutagen has to move all of the audio
+data that follows it, which means rewriting the whole file. This script 
+retags copies of test.mp3 several times, the way Track.writeTags does, and 
+counts how many of those saves moved the audio data.
+
+Two strategies are compared:
+    delete   - delete the old tags, add new ones and save once per field
+               (how tags were written before tagging.writeTags existed)
+    writeTags - tagging.writeTags, which saves once into the existing padding
+
+Run from the test directory:
+    python bench_tagging.py [ROUNDS]"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                "..", "src"))
+
+import mutagen
+import mutagen._util
+from mutagen.mp3 import MP3
+from mutagen.easyid3 import EasyID3
+
+from metadata import tagging
+
+rewrites = [0]
+
+def countRewrites():
+    """Wrap Mutagen's byte-moving helpers, wherever they were imported, to count calls."""
+    
+    for name in ("insert_bytes", "delete_bytes"):
+        original = getattr(mutagen._util, name)
+        def counting(*args, **kwargs):
+            rewrites[0] += 1
+            return original(*args, **kwargs)
+        for module in sys.modules.values():
+            if module and getattr(module, name, None) is original:
+                setattr(module, name, counting)
+
+def deleteStrategy(filePath, tags):
+    audioFile = MP3(filePath, ID3=EasyID3)
+    audioFile.delete()
+    audioFile = MP3(filePath, ID3=EasyID3)
+    audioFile.add_tags(ID3=EasyID3)
+    audioFile["tracknumber"] = u"00"
+    audioFile.save()
+    for field in tags:
+        audioFile = MP3(filePath, ID3=EasyID3)
+        audioFile[field] = tags[field]
+        audioFile.save()
+        
+def writeTagsStrategy(filePath, tags):
+    tagging.writeTags(filePath, tags)
+
+def tagsForRound(i):
+    """Return a tag set whose size varies from round to round."""
+    
+    return {"artist": u"Artist " * (1 + i % 3),
+            "album": u"Release " * (1 + (i * 2) % 5),
+            "title": u"Title " * (1 + (i * 3) % 7),
+            "date": u"2011",
+            "tracknumber": u"%02d/12" % (i % 12 + 1)}
+
+def run(strategy, rounds):
+    workDirPath = tempfile.mkdtemp()
+    filePath = os.path.join(workDirPath, "test.mp3")
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             "test.mp3"), filePath)
+    rewrites[0] = 0
+    start = time.time()
+    for i in range(rounds):
+        strategy(filePath, tagsForRound(i))
+    duration = time.time() - start
+    shutil.rmtree(workDirPath)
+    return rewrites[0], duration
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    countRewrites()
+    print "Mutagen %s, %d retaggings per strategy." % (mutagen.version_string, 
+                                                       rounds)
+    for name, strategy in (("delete", deleteStrategy), 
+                           ("writeTags", writeTagsStrategy)):
+        count, duration = run(strategy, rounds)
+        print "%-10s %4d full-file rewrites  %.3f seconds" % (name, count, 
+                                                              duration)
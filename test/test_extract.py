@@ -2,9 +2,12 @@
 
 import os.path
 import shutil
+import tarfile
+import tempfile
 import subprocess
 
 import extract
+from etc import configuration
 
 def test_extract():
     """Test extract.extract function.
@@ -42,4 +45,78 @@ def test_extract():
     
     assert actual == expected
 
-    
\ No newline at end of file
+
+def test_groupVolumes():
+    """Test that the volumes of multi-volume rar archives are grouped.
+    
+    Each set should be listed once, with the volume to extract from first."""
+    
+    archivePaths = ["/a/show.part10.rar", "/a/show.part02.rar", 
+                    "/a/show.part01.rar", "/a/old.r01", "/a/old.r00", 
+                    "/a/old.rar", "/a/single.rar", "/a/other.zip"]
+    
+    assert extract.groupVolumes(archivePaths) == [
+        ["/a/old.rar", "/a/old.r00", "/a/old.r01"],
+        ["/a/other.zip"],
+        ["/a/show.part01.rar", "/a/show.part02.rar", "/a/show.part10.rar"],
+        ["/a/single.rar"]]
+    assert extract.archiveDestination("/a/show.part01.rar") == "/a/show"
+
+
+def test_memberDestination():
+    """Test that archive members can't be written outside the folder.
+    
+    Absolute paths, paths climbing out with ".." (with either kind of slash)
+    and paths through a symlink leading outside are all refused."""
+    
+    destDirectoryPath = tempfile.mkdtemp()
+    outsidePath = tempfile.mkdtemp()
+    try:
+        os.symlink(outsidePath, os.path.join(destDirectoryPath, "link"))
+        
+        assert (extract.memberDestination(destDirectoryPath, "CD1/01 a.flac") 
+                == os.path.join(destDirectoryPath, "CD1", "01 a.flac"))
+        assert (extract.memberDestination(destDirectoryPath, "CD1/../b.flac") 
+                == os.path.join(destDirectoryPath, "b.flac"))
+        for memberName in ["/etc/passwd", "../evil.flac", "CD1/../../evil.flac",
+                           "..\\evil.flac", ".", "link/evil.flac"]:
+            assert extract.memberDestination(destDirectoryPath, memberName) is None
+    finally:
+        shutil.rmtree(destDirectoryPath)
+        shutil.rmtree(outsidePath)
+
+
+def test_compressedTarReadOnce():
+    """Test that compressed tars are not listed before being extracted.
+    
+    A gzipped tar holding audio should be extracted; one holding only a text
+    file should be removed, along with the folder it was extracted into."""
+    
+    directoryPath = tempfile.mkdtemp()
+    originalSettings = dict(configuration.SETTINGS)
+    configuration.SETTINGS["DELETE"] = True
+    try:
+        for name, memberName in [("audio", "01 Track.mp3"), 
+                                 ("notes", "notes.txt")]:
+            memberPath = os.path.join(directoryPath, memberName)
+            with open(memberPath, "wb") as f:
+                f.write("contents")
+            archive = tarfile.open(os.path.join(directoryPath, 
+                                                name + ".tar.gz"), "w:gz")
+            archive.add(memberPath, memberName)
+            archive.close()
+            os.remove(memberPath)
+        
+        assert extract.listMembers(os.path.join(directoryPath, 
+                                                "audio.tar.gz")) is None
+        assert (extract.extractSet([os.path.join(directoryPath, 
+                                                 "notes.tar.gz")]) is None)
+        assert (extract.extractSet([os.path.join(directoryPath, 
+                                                 "audio.tar.gz")]) == 
+                os.path.join(directoryPath, "audio.tar"))
+        assert sorted(os.listdir(directoryPath)) == ["audio.tar"]
+        assert os.listdir(os.path.join(directoryPath, "audio.tar")) == [
+            "01 Track.mp3"]
+    finally:
+        configuration.SETTINGS.update(originalSettings)
+        shutil.rmtree(directoryPath)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+from finders.AbstractFinder import AbstractReleaseFinder
+from etc import configuration
+
+class FakeTrack(object):
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+
+class FakeRelease(object):
+    def __init__(self, numTracks):
+        self.tracks = [FakeTrack("%d.ogg" % (i + 1)) for i in range(numTracks)]
+        self.metadata = {}
+
+    def storeData(self, field, value):
+        self.metadata[field] = value
+
+
+class FakeFinder(AbstractReleaseFinder):
+    """Finds the release from two getters which record the calls made."""
+
+    fieldName = "release"
+
+    def __init__(self, heavyResults, lightResults):
+        self.heavyResults = heavyResults
+        self.lightResults = lightResults
+        self.calls = []
+        self.getters = [(self.getHeavy, 5), (self.getLight, 4)]
+
+    def getHeavy(self, track):
+        self.calls.append(("getHeavy", track.fileName))
+        return self.heavyResults.get(track.fileName)
+
+    def getLight(self, track):
+        self.calls.append(("getLight", track.fileName))
+        return self.lightResults.get(track.fileName)
+
+
+def withSettings(settings, fn):
+    originalSettings = dict(configuration.SETTINGS)
+    configuration.SETTINGS.update(settings)
+    try:
+        return fn()
+    finally:
+        configuration.SETTINGS.update(originalSettings)
+
+def test_samplingOffByDefault():
+    """Test that every track of a large release is asked by default."""
+
+    finder = FakeFinder(dict(("%d.ogg" % i, u"A") for i in range(1, 13)), {})
+    release = FakeRelease(12)
+    assert finder.firstSampleSize(release) == 12
+
+def test_samplingKeepsResult():
+    """Test that sampling a release gives the same result as asking every track.
+
+    In the first case the heavy getter finds "A" for tracks 1 and 4, which
+    are the first sample, but the light getter finds "B" for every track,
+    which wins (16 points to 10) once every track is counted. In the second
+    every getter agrees."""
+
+    def findRelease(heavyResults, lightResults, settings):
+        release = FakeRelease(4)
+        withSettings(settings, lambda: FakeFinder(heavyResults, 
+                                                  lightResults).run(release))
+        return release.metadata
+
+    sampled = {"SAMPLE_ABOVE": 2, "SAMPLE_SIZE": 2, "SAMPLE_POLICY": "spread"}
+    unsampled = {"SAMPLE_ABOVE": None}
+    cases = [({"1.ogg": u"A", "4.ogg": u"A"},
+              dict(("%d.ogg" % i, u"B") for i in range(1, 5))),
+             (dict(("%d.ogg" % i, u"A") for i in range(1, 5)),
+              dict(("%d.ogg" % i, u"A") for i in range(1, 5)))]
+    for heavyResults, lightResults in cases:
+        assert (findRelease(heavyResults, lightResults, sampled) ==
+                findRelease(heavyResults, lightResults, unsampled))
+    assert findRelease(cases[0][0], cases[0][1], sampled) == {"release": u"B"}
+
+def test_isDecided():
+    """Test AbstractFinder.isDecided against the weight still to come.
+
+    The field is decided when the leading group, and the leading spelling
+    within it, are ahead by more than the remaining weight (not just as
+    much)."""
+
+    finder = FakeFinder({}, {})
+    data = [(u"Album", 5, "getHeavy", "1"), (u"album", 3, "getLight", "1"),
+            (u"Other", 2, "getLight", "2")]
+
+    # "album" leads "other" by 6 and "Album" leads "album" by 2.
+    assert finder.isDecided(data, 1)
+    assert not finder.isDecided(data, 2)
+    assert not finder.isDecided([], 0)
+    assert finder.isDecided([(u"Album", 5, "getHeavy", "1")], 4)
+    assert not finder.isDecided([(u"Album", 5, "getHeavy", "1")], 5)
+
+def test_gatherDataStopsWhenDecided():
+    """Test that no more getters are called once the result is decided.
+
+    The heavy getter agrees on all three tracks (15 points), more than the
+    light getter could add (12), so the light getter is never called."""
+
+    finder = FakeFinder(dict(("%d.ogg" % i, u"A") for i in range(1, 4)),
+                        dict(("%d.ogg" % i, u"B") for i in range(1, 4)))
+    release = FakeRelease(3)
+    data = []
+    assert finder.gatherData(release.tracks, data)
+    assert sorted(finder.calls) == [("getHeavy", "1.ogg"),
+                                    ("getHeavy", "2.ogg"),
+                                    ("getHeavy", "3.ogg")]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from etc import configuration, functions
+
+def test_inventoryUpdate():
+    """Test that Inventory.update matches listing the directory again.
+    
+    Created files should be added under their types (in order), removed ones
+    dropped along with types left empty, and created subdirectories returned
+    as new. Items created elsewhere should be ignored, and removing the 
+    directory itself should leave the inventory empty."""
+    
+    directoryPath = tempfile.mkdtemp()
+    otherPath = tempfile.mkdtemp()
+    try:
+        for name in ("b.mp3", "release.zip", "notes.txt"):
+            open(os.path.join(directoryPath, name), "w").close()
+        inventory = functions.Inventory(directoryPath)
+        
+        path = lambda name: os.path.join(directoryPath, name)
+        open(path("a.mp3"), "w").close()
+        os.mkdir(path("CD1"))
+        os.remove(path("release.zip"))
+        open(os.path.join(otherPath, "c.mp3"), "w").close()
+        newSubdirectoryPaths = inventory.update(
+            [path("a.mp3"), path("CD1"), os.path.join(otherPath, "c.mp3")], 
+            [path("release.zip")])
+        
+        assert newSubdirectoryPaths == [path("CD1")]
+        assert inventory.subdirectoryPaths == [path("CD1")]
+        assert inventory.filePathsByType == {
+            "good_audio": [path("a.mp3"), path("b.mp3")],
+            "other": [path("notes.txt")]}
+        relisted = functions.Inventory(directoryPath)
+        assert inventory.subdirectoryPaths == relisted.subdirectoryPaths
+        assert inventory.filePathsByType == relisted.filePathsByType
+        
+        assert inventory.update([path("CD1")], []) == []
+        assert inventory.update([], [directoryPath]) == []
+        assert inventory.subdirectoryPaths == []
+        assert inventory.filePathsByType == {}
+    finally:
+        shutil.rmtree(directoryPath)
+        shutil.rmtree(otherPath)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import traverse
+from etc import configuration, functions, journal
+
+def writeFile(filePath, contents):
+    with open(filePath, "wb") as f:
+        f.write(contents)
+
+def test_resume():
+    """Test that a reloaded journal picks up where the last run left off.
+
+    A directory had an archive extracted and a file converted but the run
+    stopped before removing them; since then the converted file's name has
+    been taken by a new file. Another directory was finished. After the
+    journal is reloaded, the unfinished directory's entry should be back, the
+    archive should be removed and the new file kept."""
+
+    directoryPath = tempfile.mkdtemp()
+    journalDirectoryPath = tempfile.mkdtemp()
+    archivePath = os.path.join(directoryPath, u"release.zip")
+    convertedPath = os.path.join(directoryPath, u"track.wv")
+    writeFile(archivePath, "archive")
+    writeFile(convertedPath, "old audio")
+    originalJournalPath = journal.JOURNAL_PATH
+    originalSettings = dict(configuration.SETTINGS)
+    originalPaths = dict(configuration.PATHS)
+    journal.JOURNAL_PATH = os.path.join(journalDirectoryPath, 
+                                        ".audiolog_journal")
+    configuration.SETTINGS.update({"JOURNAL": True, "DELETE": True})
+    configuration.PATHS["CURRENT"] = directoryPath
+    try:
+        journal.load()
+        journal.record(directoryPath, "extract", inputs=[archivePath])
+        journal.record(directoryPath, "convert", inputs=[convertedPath])
+        journal.record(directoryPath, "identify", release={"artist": u"Sigur Rós"},
+                       tracks={})
+        journal.record(u"/finished", "convert", inputs=[])
+        journal.finish(u"/finished")
+
+        writeFile(convertedPath, "new audio, not converted yet")
+        journal.load()
+
+        entry = journal.getEntry(directoryPath)
+        assert entry["identify"] == {"release": {"artist": u"Sigur Rós"},
+                                     "tracks": {}}
+        assert [inputPath for inputPath, size, mtime in entry["inputs"]] == [
+            archivePath, convertedPath]
+        assert journal.getEntry(u"/finished") == {}
+        assert journal.finishedInputs(directoryPath) == [archivePath]
+
+        inventory = functions.Inventory(directoryPath)
+        traverse.removeFinishedInputs(inventory)
+        assert not os.path.exists(archivePath)
+        assert os.path.exists(convertedPath)
+        assert inventory.filePathsByType == {"bad_audio": [convertedPath]}
+    finally:
+        if journal.journalFile:
+            journal.journalFile.close()
+            journal.journalFile = None
+        journal.entries.clear()
+        journal.JOURNAL_PATH = originalJournalPath
+        configuration.SETTINGS.update(originalSettings)
+        configuration.PATHS.update(originalPaths)
+        shutil.rmtree(directoryPath)
+        shutil.rmtree(journalDirectoryPath)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from etc import cache, configuration, functions, manifest
+
+def writeFile(filePath, contents, mtime=1000000000):
+    with open(filePath, "wb") as f:
+        f.write(contents)
+    os.utime(filePath, (mtime, mtime))
+
+def useMemoryManifest():
+    """Keep the manifest in an empty database in memory."""
+
+    cache.dbConn = sqlite3.connect(":memory:", check_same_thread=False)
+    cache.cursor = cache.dbConn.cursor()
+    cache.cursor.execute("create table manifest (path text primary key, "
+                         "signature text, outcome text, time real)")
+
+def signatureOf(directoryPath, subdirectorySignatures=()):
+    return manifest.directorySignature(functions.Inventory(directoryPath),
+                                       list(subdirectorySignatures))
+
+def test_directorySignature():
+    """Test that a directory's signature changes exactly when it should.
+
+    It should stay the same while nothing changes and change when a file is
+    added or changes size or time, when a subdirectory's signature changes
+    and when a setting that affects handling changes."""
+
+    directoryPath = tempfile.mkdtemp()
+    filePath = os.path.join(directoryPath, "01 Track.mp3")
+    originalActions = dict(configuration.ACTIONS)
+    try:
+        writeFile(filePath, "audio")
+        signature = signatureOf(directoryPath)
+        assert signatureOf(directoryPath) == signature
+
+        signatures = set([signature])
+        writeFile(filePath, "audio", mtime=1000000001)
+        signatures.add(signatureOf(directoryPath))
+        writeFile(filePath, "more audio", mtime=1000000001)
+        signatures.add(signatureOf(directoryPath))
+        writeFile(os.path.join(directoryPath, "cover.jpg"), "image")
+        signatures.add(signatureOf(directoryPath))
+        signatures.add(signatureOf(directoryPath, [(u"CD1", "a")]))
+        signatures.add(signatureOf(directoryPath, [(u"CD1", "b")]))
+        configuration.ACTIONS["CONVERT"] = not configuration.ACTIONS["CONVERT"]
+        signatures.add(signatureOf(directoryPath))
+        assert len(signatures) == 7
+    finally:
+        configuration.ACTIONS.update(originalActions)
+        shutil.rmtree(directoryPath)
+
+def test_treeSignatures():
+    """Test that manifest.treeSignatures agrees with subtreeSignature.
+
+    Nothing is recorded, so both work everything out from the files; a
+    change deep in the tree should change the signatures of every directory
+    above it and no others."""
+
+    rootPath = tempfile.mkdtemp()
+    releasePath = os.path.join(rootPath, u"Release")
+    discPath = os.path.join(releasePath, u"CD1")
+    otherPath = os.path.join(rootPath, u"Other")
+    for directoryPath in (discPath, otherPath):
+        os.makedirs(directoryPath)
+        writeFile(os.path.join(directoryPath, "01.mp3"), "audio")
+    useMemoryManifest()
+    try:
+        signatures = manifest.treeSignatures(rootPath)
+        assert sorted(signatures) == sorted([rootPath, releasePath, discPath,
+                                             otherPath])
+        for directoryPath, signature in signatures.items():
+            assert manifest.subtreeSignature(directoryPath) == signature
+
+        writeFile(os.path.join(discPath, "01.mp3"), "new audio")
+        newSignatures = manifest.treeSignatures(rootPath)
+        changed = [path for path in signatures
+                   if signatures[path] != newSignatures[path]]
+        assert sorted(changed) == sorted([rootPath, releasePath, discPath])
+
+        skipped = manifest.treeSignatures(rootPath,
+                                          lambda path: path == otherPath)
+        assert otherPath not in skipped and discPath in skipped
+    finally:
+        cache.dbConn = None
+        shutil.rmtree(rootPath)
+
+def test_isUnchanged():
+    """Test that only directories handled with the same signature are skipped."""
+
+    directoryPath = tempfile.mkdtemp()
+    writeFile(os.path.join(directoryPath, "01.mp3"), "audio")
+    useMemoryManifest()
+    try:
+        signature = manifest.subtreeSignature(directoryPath)
+        assert not manifest.isUnchanged(directoryPath, signature)
+
+        manifest.record(directoryPath, "failed")
+        assert not manifest.isUnchanged(directoryPath, signature)
+
+        manifest.record(directoryPath, "handled")
+        assert manifest.isUnchanged(directoryPath, signature)
+        assert not manifest.isUnchanged(directoryPath, "other")
+
+        shutil.rmtree(directoryPath)
+        manifest.record(directoryPath, "handled")
+        assert manifest.getSignature(directoryPath) is None
+    finally:
+        cache.dbConn = None
+        if os.path.exists(directoryPath):
+            shutil.rmtree(directoryPath)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+import split
+
+def parseCueText(text):
+    """Write text to a temporary cue file and return what split.parseCue makes
+    of it."""
+
+    directoryPath = tempfile.mkdtemp()
+    cuePath = os.path.join(directoryPath, "image.cue")
+    try:
+        with open(cuePath, "wb") as f:
+            f.write(text)
+        return split.parseCue(cuePath)
+    finally:
+        shutil.rmtree(directoryPath)
+
+def test_parseCue():
+    """Test that split.parseCue reads the tracks and their starts.
+
+    Tracks start at INDEX 01; the pregap before it (INDEX 00) belongs to the
+    track before. Titles may be non-ASCII (the file is UTF-8 here)."""
+
+    release, tracks = parseCueText(
+        'REM GENRE Rock\r\n'
+        'REM DATE 1999\r\n'
+        'PERFORMER "Sigur Rós"\r\n'
+        'TITLE "Ágætis byrjun"\r\n'
+        'FILE "image.ape" WAVE\r\n'
+        '  TRACK 01 AUDIO\r\n'
+        '    TITLE "Intro"\r\n'
+        '    INDEX 01 00:00:00\r\n'
+        '  TRACK 02 AUDIO\r\n'
+        '    TITLE "Svefn-g-englar"\r\n'
+        '    INDEX 00 01:35:50\r\n'
+        '    INDEX 01 01:37:10\r\n'
+        '  TRACK 03 AUDIO\r\n'
+        '    TITLE "Starálfur"\r\n'
+        '    PERFORMER "Guest"\r\n'
+        '    INDEX 01 11:40:74\r\n')
+
+    assert release == {"artist": u"Sigur Rós",
+                       "release": u"Ágætis byrjun",
+                       "genre": u"Rock", "date": u"1999"}
+    assert tracks == [
+        {"tracknumber": u"1", "title": u"Intro", "start": 0},
+        {"tracknumber": u"2", "title": u"Svefn-g-englar",
+         "start": (1 * 60 + 37) * 75 + 10},
+        {"tracknumber": u"3", "title": u"Starálfur",
+         "artist": u"Guest", "start": (11 * 60 + 40) * 75 + 74}]
+
+def test_parseCueRejects():
+    """Test that split.parseCue gives up on cues it can't split in one pass.
+
+    These are cues referring to more than one file and cues with a track
+    that has no INDEX 01."""
+
+    assert parseCueText('FILE "one.wav" WAVE\n'
+                        '  TRACK 01 AUDIO\n'
+                        '    INDEX 01 00:00:00\n'
+                        'FILE "two.wav" WAVE\n'
+                        '  TRACK 02 AUDIO\n'
+                        '    INDEX 01 00:00:00\n') is None
+    assert parseCueText('FILE "one.wav" WAVE\n'
+                        '  TRACK 01 AUDIO\n'
+                        '    INDEX 01 00:00:00\n'
+                        '  TRACK 02 AUDIO\n'
+                        '    INDEX 00 04:00:00\n') is None
+
+def test_planTracks():
+    """Test that split.planTracks maps the tracks of a cue to Ogg files.
+
+    Each track should end where the next starts and be tagged with the
+    release's metadata, its own and the number of tracks."""
+
+    release = {"artist": u"Artist", "release": u"Album"}
+    tracks = [{"tracknumber": u"1", "title": u"Café/Bar", "start": 0},
+              {"tracknumber": u"2", "start": 7500, "artist": u"Guest"}]
+
+    assert split.planTracks(u"/music", release, tracks) == [
+        (0, 7500, u"/music/01 - Café-Bar.ogg",
+         {"artist": u"Artist", "release": u"Album", "tracknumber": u"1",
+          "title": u"Café/Bar", "tracktotal": u"2"}),
+        (7500, None, u"/music/02 - Track.ogg",
+         {"artist": u"Guest", "release": u"Album", "tracknumber": u"2",
+          "tracktotal": u"2"})]
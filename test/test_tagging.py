@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from metadata import tagging
+
+def test_combineTrackFields():
+    """Test that the track number and total are folded into one field.
+    
+    A missing track number is written as "00", also when there is no total,
+    as clearTags leaves it."""
+    
+    for tags, expected in [({"tracknumber": u"3", "tracktotal": u"12"}, u"3/12"),
+                           ({"tracknumber": u"3"}, u"3"),
+                           ({"tracktotal": u"12"}, u"00/12"),
+                           ({}, u"00")]:
+        tags = dict(tags, title=u"Title")
+        tagging.combineTrackFields(tags)
+        assert tags == {"tracknumber": expected, "title": u"Title"}
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import os
+import errno
+import shutil
+import tempfile
+
+import pytest
+
+from etc import configuration, transfer
+
+def writeFile(filePath, contents):
+    with open(filePath, "wb") as f:
+        f.write(contents)
+
+def readFile(filePath):
+    with open(filePath, "rb") as f:
+        return f.read()
+
+def test_renameRefusesToOverwrite():
+    """Test that transfer.rename never replaces an existing destination.
+    
+    It should raise OSError with errno EEXIST and leave both files as they 
+    were, and return False (moving nothing) between filesystems."""
+    
+    directoryPath = tempfile.mkdtemp()
+    sourcePath = os.path.join(directoryPath, "source.mp3")
+    destPath = os.path.join(directoryPath, "dest.mp3")
+    writeFile(sourcePath, "new")
+    writeFile(destPath, "old")
+    originalRename = os.rename
+    try:
+        with pytest.raises(OSError) as excInfo:
+            transfer.rename(sourcePath, destPath)
+        assert excInfo.value.errno == errno.EEXIST
+        assert readFile(sourcePath) == "new"
+        assert readFile(destPath) == "old"
+        
+        def crossDeviceRename(sourcePath, destPath):
+            raise OSError(errno.EXDEV, "Invalid cross-device link")
+        os.rename = crossDeviceRename
+        otherPath = os.path.join(directoryPath, "other.mp3")
+        assert transfer.rename(sourcePath, otherPath) is False
+        assert os.path.exists(sourcePath) and not os.path.exists(otherPath)
+    finally:
+        os.rename = originalRename
+        shutil.rmtree(directoryPath)
+
+def test_copyAndRemove():
+    """Test that transfer.copyAndRemove cleans up after itself.
+    
+    A copy that checks out replaces the source. A copy that fails the check
+    is deleted and the source kept. An existing destination is left alone."""
+    
+    directoryPath = tempfile.mkdtemp()
+    sourcePath = os.path.join(directoryPath, "source.flac")
+    destPath = os.path.join(directoryPath, "dest.flac")
+    originalVerifyCopy = transfer.verifyCopy
+    try:
+        writeFile(sourcePath, "audio" * 1000)
+        assert transfer.copyAndRemove(sourcePath, destPath) == 5000
+        assert readFile(destPath) == "audio" * 1000
+        assert not os.path.exists(sourcePath)
+        
+        writeFile(sourcePath, "other")
+        with pytest.raises(OSError):
+            transfer.copyAndRemove(sourcePath, destPath)
+        assert readFile(destPath) == "audio" * 1000
+        assert readFile(sourcePath) == "other"
+        
+        def failVerifyCopy(sourcePath, destPath):
+            raise IOError(errno.EIO, "Copy has the wrong size", destPath)
+        transfer.verifyCopy = failVerifyCopy
+        badCopyPath = os.path.join(directoryPath, "copy.flac")
+        with pytest.raises(IOError):
+            transfer.copyAndRemove(sourcePath, badCopyPath)
+        assert not os.path.exists(badCopyPath)
+        assert readFile(sourcePath) == "other"
+    finally:
+        transfer.verifyCopy = originalVerifyCopy
+        shutil.rmtree(directoryPath)
+
+def test_moveFilesRecordsFailures():
+    """Test that transfer.moveFiles carries on past files it can't move.
+    
+    Files are copied here (as if to another filesystem); a source which has
+    disappeared should be reported in the failures, not stop the others."""
+    
+    directoryPath = tempfile.mkdtemp()
+    originalRename = transfer.rename
+    try:
+        transfer.rename = lambda sourcePath, destPath: False
+        path = lambda name: os.path.join(directoryPath, name)
+        writeFile(path("a.mp3"), "a")
+        writeFile(path("c.mp3"), "c")
+        failures = transfer.moveFiles([(path("a.mp3"), path("a2.mp3")),
+                                       (path("b.mp3"), path("b2.mp3")),
+                                       (path("c.mp3"), path("c2.mp3"))])
+        assert [sourcePath for sourcePath, e in failures] == [path("b.mp3")]
+        assert sorted(os.listdir(directoryPath)) == ["a2.mp3", "c2.mp3"]
+    finally:
+        transfer.rename = originalRename
+        shutil.rmtree(directoryPath)
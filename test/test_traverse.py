@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import pytest
+
+import traverse
+from etc import cache, configuration, manifest, workers
+
+class CancellableJob(workers.Job):
+    """A job which finishes, without running, as soon as it is cancelled."""
+
+    def cancel(self):
+        workers.Job.cancel(self)
+        self.run()
+
+
+class FailFirstPool(object):
+    """Stands in for the directory pool.
+
+    The first directory submitted is handled straight away; the others wait
+    until they are cancelled."""
+
+    def __init__(self):
+        self.numSubmitted = 0
+
+    def inWorker(self):
+        return False
+
+    def submit(self, fn, *args):
+        job = CancellableJob(fn, args, {})
+        self.numSubmitted += 1
+        if self.numSubmitted == 1:
+            job.run()
+        return job
+
+
+def test_cancelledNotRecorded():
+    """Test that traverse.traverseConcurrently records only finished directories.
+
+    Handling the first directory fails, so the second one's job is cancelled
+    before it starts. The first should be recorded as failed and the second
+    not recorded at all, so that incremental runs don't skip it."""
+
+    def handleDirectory(directoryPath, inventory=None):
+        raise IOError("Handling failed.")
+
+    rootPath = tempfile.mkdtemp()
+    for name in ("a", "b"):
+        os.mkdir(os.path.join(rootPath, name))
+        open(os.path.join(rootPath, name, name + ".mp3"), "w").close()
+
+    cache.dbConn = sqlite3.connect(":memory:", check_same_thread=False)
+    cache.cursor = cache.dbConn.cursor()
+    cache.cursor.execute("create table manifest (path text primary key, "
+                         "signature text, outcome text, time real)")
+    originalSettings = dict(configuration.SETTINGS)
+    originalGetPool = traverse.getDirectoryPool
+    originalHandleDirectory = traverse.handleDirectory
+    pool = FailFirstPool()
+    configuration.SETTINGS.update({"INCREMENTAL": True, "PIPELINE": False})
+    traverse.getDirectoryPool = lambda: pool
+    traverse.handleDirectory = handleDirectory
+    try:
+        with pytest.raises(IOError):
+            traverse.traverseConcurrently(rootPath)
+
+        cache.cursor.execute("select path, outcome from manifest")
+        outcomes = dict(cache.cursor.fetchall())
+        assert outcomes == {os.path.join(rootPath, "a"): "failed"}
+        assert not manifest.isUnchanged(os.path.join(rootPath, "b"),
+                                        manifest.subtreeSignature(
+                                            os.path.join(rootPath, "b")))
+    finally:
+        configuration.SETTINGS.update(originalSettings)
+        traverse.getDirectoryPool = originalGetPool
+        traverse.handleDirectory = originalHandleDirectory
+        cache.dbConn = None
+        shutil.rmtree(rootPath)